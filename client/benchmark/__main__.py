@@ -0,0 +1,121 @@
+from datetime import datetime
+import argparse
+import asyncio
+import cProfile
+import json
+import sys
+import os
+
+from .harness import BACKENDS, run
+
+def parse_size(value: str):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def print_report(report: dict):
+    startup, scroll, memory = report["startup"], report["scroll"], report["memory"]
+    print(f"feed visible after login   {startup['feed_visible_ms']:>10} ms  (posts {startup['posts_ms']} ms, first image {startup['first_image_ms']} ms)")
+    print(f"scroll step p50/p95        {scroll['steps'].get('p50_ms'):>10} / {scroll['steps'].get('p95_ms')} ms")
+    print(f"scroll frames              {scroll['frames']:>10}  ({scroll['fps']} fps, {scroll['frame_time_ms']} ms per frame, {scroll['output_bytes']} bytes)")
+    print(f"peak RSS                   {memory['peak_rss_mb']:>10} MB  ({memory['peak_image_widgets']} image widgets at most)")
+    for name, timing in report["images"].items():
+        if timing["count"]:
+            print(f"{name:26} {timing['p50_ms']:>10} ms p50, {timing['p95_ms']} ms p95 over {timing['count']}")
+    if report["timeouts"]:
+        print(f"WARNING: images did not show up in time {report['timeouts']} times, those timings are the timeout")
+
+def compare(old: dict, new: dict, threshold: float):
+    # the metrics where bigger is worse
+    metrics = [
+        ("feed visible ms", lambda r: r["startup"]["feed_visible_ms"]),
+        ("scroll step p95 ms", lambda r: r["scroll"]["steps"].get("p95_ms")),
+        ("frame ms", lambda r: r["scroll"]["frame_time_ms"]),
+        ("peak RSS MB", lambda r: r["memory"]["peak_rss_mb"]),
+    ] + [
+        (f"{name} p50 ms", lambda r, name=name: r["images"].get(name, {}).get("p50_ms"))
+        for name in new["images"]
+    ]
+    regressed = False
+    for label, get in metrics:
+        before, after = get(old), get(new)
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        worse = change > threshold
+        regressed = regressed or worse
+        print(f"{label:28} {before:>10} -> {after:<10} {change:+.1f}%{'  REGRESSION' if worse else ''}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Measure how fast the client shows and scrolls the feed.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the app headless against a stub server and save the results as JSON")
+    run_parser.add_argument("--posts", type=int, default=100)
+    run_parser.add_argument("--images", type=int, default=10, help="distinct images served by the stub")
+    run_parser.add_argument("--image-size", type=parse_size, default=(1024, 768), help="WIDTHxHEIGHT of the originals")
+    run_parser.add_argument("--rendition", choices=["original", "display"], default="original",
+                            help="serve originals the client has to compose, or the server's 512x512 renditions")
+    run_parser.add_argument("--latency", type=float, default=0, help="milliseconds the stub waits before answering")
+    run_parser.add_argument("--scroll-steps", type=int, default=20, help="screens to scroll down")
+    run_parser.add_argument("--terminal-size", type=parse_size, default=(120, 50), help="COLUMNSxROWS")
+    run_parser.add_argument("--backend", choices=list(BACKENDS), default="auto", help="textual-image widget to render with")
+    run_parser.add_argument("--cache-dir", help="image cache to use, run twice with the same directory to measure a warm cache")
+    run_parser.add_argument("--url", help="use a real server instead of the stub")
+    run_parser.add_argument("--username", default="bench")
+    run_parser.add_argument("--password", default="bench")
+    run_parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the images on screen")
+    run_parser.add_argument("--profile", choices=["cprofile", "pyinstrument"], help="also profile the run")
+    run_parser.add_argument("--output", help="results file, defaults to bench-results/client-<timestamp>.json")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        output = args.output or os.path.join("bench-results", f"client-{datetime.now():%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        coroutine = run(
+            posts=args.posts, images=args.images, image_size=args.image_size, rendition=args.rendition,
+            latency=args.latency / 1000, scroll_steps=args.scroll_steps, size=args.terminal_size,
+            backend=args.backend, cache_dir=args.cache_dir, url=args.url,
+            username=args.username, password=args.password, timeout=args.timeout
+        )
+        profile_output = os.path.splitext(output)[0] + (".prof" if args.profile == "cprofile" else ".html")
+        if args.profile == "cprofile":
+            # image processing runs in threads, which neither profiler sees, the harness times it instead
+            profiler = cProfile.Profile()
+            report = profiler.runcall(asyncio.run, coroutine)
+            profiler.dump_stats(profile_output)
+        elif args.profile == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                print("pyinstrument is not installed, run: pip install pyinstrument")
+                sys.exit(1)
+            profiler = Profiler(async_mode="disabled")
+            profiler.start()
+            report = asyncio.run(coroutine)
+            profiler.stop()
+            with open(profile_output, "w") as f:
+                f.write(profiler.output_html())
+        else:
+            report = asyncio.run(coroutine)
+
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print_report(report)
+        print(f"Saved to {output}" + (f", profile in {profile_output}" if args.profile else ""))
+
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+from datetime import datetime, timezone
+from textual.widgets import Input
+from textual._compositor import Compositor
+import celar.__main__ as celar
+from celar.cache import ImageCache
+import textual_image.widget
+from .stub import StubServer, STUB_URL
+import tempfile
+import asyncio
+import time
+import sys
+import os
+
+BACKENDS = {
+    "auto": textual_image.widget.Image,
+    "tgp": textual_image.widget.TGPImage,
+    "sixel": textual_image.widget.SixelImage,
+    "halfcell": textual_image.widget.HalfcellImage,
+    "unicode": textual_image.widget.UnicodeImage,
+}
+
+class Recorder:
+    # collects timings from the patched client functions
+    def __init__(self):
+        self.timings = {}
+        self.frames = 0
+        self.frame_time = 0.0
+        self.output_bytes = 0
+        self.peak_rss = 0
+        self.live_images = 0
+        self.peak_images = 0
+        self.console = None
+
+    def add(self, name: str, seconds: float):
+        self.timings.setdefault(name, []).append(seconds)
+
+    def timed(self, name: str, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    def timed_async(self, name: str, func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+def current_rss():
+    # bytes, from /proc on Linux and the peak from getrusage elsewhere (0 on Windows)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3),
+        "p50_ms": round(pick(50) * 1000, 3),
+        "p95_ms": round(pick(95) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+def instrument(recorder: Recorder, backend: str):
+    # wraps the expensive client functions; returns a function that undoes it
+    patched = [
+        (celar, "prepare_image", recorder.timed("prepare_image", celar.prepare_image)),
+        (celar, "load_processed_image", recorder.timed("load_processed_image", celar.load_processed_image)),
+        (celar, "fetch_post_image", recorder.timed_async("fetch_post_image", celar.fetch_post_image)),
+    ]
+
+    base = BACKENDS[backend]
+    class TimedImage(base, Renderable=base._Renderable):
+        def on_mount(self):
+            recorder.live_images += 1
+            recorder.peak_images = max(recorder.peak_images, recorder.live_images)
+
+        def on_unmount(self):
+            recorder.live_images -= 1
+
+        def render(self):
+            start = time.perf_counter()
+            try:
+                return super().render()
+            finally:
+                recorder.add("image_widget_render", time.perf_counter() - start)
+    patched.append((celar, "Image", TimedImage))
+
+    # a frame is one compositor update, headless apps skip writing it, so it's encoded here
+    render_update = Compositor.render_update
+    def timed_render_update(self, *args, **kwargs):
+        start = time.perf_counter()
+        update = render_update(self, *args, **kwargs)
+        if update is not None:
+            recorder.output_bytes += len(update.render_segments(recorder.console).encode("utf-8"))
+            recorder.frames += 1
+            recorder.frame_time += time.perf_counter() - start
+        return update
+    patched.append((Compositor, "render_update", timed_render_update))
+
+    originals = [(owner, name, getattr(owner, name)) for owner, name, _ in patched]
+    for owner, name, value in patched:
+        setattr(owner, name, value)
+    def restore():
+        for owner, name, value in originals:
+            setattr(owner, name, value)
+    return restore
+
+async def wait_for(pilot, condition, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        await pilot.pause(0.005)
+    return True
+
+def visible_posts(scroll):
+    top, bottom = scroll.scroll_y, scroll.scroll_y + scroll.size.height
+    return [
+        post for post in scroll.query(celar.Post)
+        if post.virtual_region and post.virtual_region.bottom > top and post.virtual_region.y < bottom
+    ]
+
+def visible_images_shown(scroll):
+    posts = visible_posts(scroll)
+    return bool(posts) and all(post.image_state == "shown" for post in posts)
+
+async def run(posts: int = 100, images: int = 10, image_size=(1024, 768), rendition: str = "original",
+              latency: float = 0.0, scroll_steps: int = 20, size=(120, 50), backend: str = "auto",
+              cache_dir: str = None, url: str = None, username: str = "bench", password: str = "bench",
+              timeout: float = 60.0):
+    recorder = Recorder()
+    stub = None
+    if url is None:
+        stub = StubServer(posts=posts, images=images, image_size=image_size, rendition=rendition, latency=latency)
+    with tempfile.TemporaryDirectory(prefix="celar-bench-") as temp_dir:
+        # never read from or fill the user's real image cache
+        celar.IMAGE_CACHE = ImageCache(root=cache_dir or temp_dir)
+        restore = instrument(recorder, backend)
+        rss_task = None
+        try:
+            app = celar.CelarApp()
+            if stub is not None:
+                await app.api.close()
+                app.api = celar.CelarClient(transport=stub.transport())
+            recorder.console = app.console
+            start = time.perf_counter()
+
+            async def sample_rss():
+                while True:
+                    recorder.peak_rss = max(recorder.peak_rss, current_rss())
+                    await asyncio.sleep(0.02)
+            rss_task = asyncio.create_task(sample_rss())
+
+            async with app.run_test(size=size) as pilot:
+                await pilot.pause()
+                app.screen.query_one("#api-url", Input).value = url or STUB_URL
+                await pilot.click("#submit")
+                await wait_for(pilot, lambda: isinstance(app.screen, celar.MainMenu), timeout)
+                await pilot.click("#login")
+                await wait_for(pilot, lambda: isinstance(app.screen, celar.LoginMenu), timeout)
+                app.screen.values = {"username": username, "password": password}
+
+                login_clicked = time.perf_counter()
+                await pilot.click("#submit")
+                if not await wait_for(pilot, lambda: isinstance(app.screen, celar.Feed) and app.screen.query(celar.Post), timeout):
+                    raise RuntimeError("The feed did not load")
+                posts_shown = time.perf_counter()
+                scroll = app.screen.query_one(celar.PostScroll)
+                # a wait that runs out is counted, its time would otherwise pass for a measurement
+                timeouts = 0
+                timeouts += not await wait_for(pilot, lambda: any(post.image_state == "shown" for post in scroll.query(celar.Post)), timeout)
+                first_image = time.perf_counter()
+                timeouts += not await wait_for(pilot, lambda: visible_images_shown(scroll), timeout)
+                feed_visible = time.perf_counter()
+
+                # scroll one screen at a time, waiting until the images on screen are shown
+                frames_before, frame_time_before, bytes_before = recorder.frames, recorder.frame_time, recorder.output_bytes
+                steps = []
+                scroll_start = time.perf_counter()
+                for _ in range(scroll_steps):
+                    step_start = time.perf_counter()
+                    scroll.scroll_to(y=scroll.scroll_y + scroll.size.height, animate=False)
+                    await pilot.pause()
+                    timeouts += not await wait_for(pilot, lambda: visible_images_shown(scroll), timeout)
+                    steps.append(time.perf_counter() - step_start)
+                scroll_time = time.perf_counter() - scroll_start
+                scroll_frames = recorder.frames - frames_before
+                loaded_posts = len(scroll.query(celar.Post))
+                http_stats = app.api.stats()
+                app.exit()
+        finally:
+            if rss_task is not None:
+                rss_task.cancel()
+            restore()
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "target": url or "stub",
+            "posts": posts if url is None else None,
+            "images": images if url is None else None,
+            "image_size": list(image_size) if url is None else None,
+            "rendition": rendition if url is None else None,
+            "latency_ms": latency * 1000,
+            "scroll_steps": scroll_steps,
+            "terminal_size": list(size),
+            "backend": backend,
+            "backend_class": BACKENDS[backend].__name__,
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+        },
+        "startup": {
+            "posts_ms": round((posts_shown - login_clicked) * 1000, 3),
+            "first_image_ms": round((first_image - login_clicked) * 1000, 3),
+            "feed_visible_ms": round((feed_visible - login_clicked) * 1000, 3),
+            "total_ms": round((feed_visible - start) * 1000, 3),
+        },
+        "timeouts": timeouts,
+        "scroll": {
+            "steps": summarize(steps),
+            "duration_ms": round(scroll_time * 1000, 3),
+            "frames": scroll_frames,
+            "fps": round(scroll_frames / scroll_time, 2) if scroll_time else 0,
+            "frame_time_ms": round((recorder.frame_time - frame_time_before) / scroll_frames * 1000, 3) if scroll_frames else None,
+            "output_bytes": recorder.output_bytes - bytes_before,
+            "posts_loaded": loaded_posts,
+        },
+        "images": {name: summarize(values) for name, values in recorder.timings.items()},
+        "memory": {
+            "peak_rss_mb": round(recorder.peak_rss / 1024 / 1024, 1),
+            "peak_image_widgets": recorder.peak_images,
+        },
+        "frames": {
+            "total": recorder.frames,
+            "time_ms": round(recorder.frame_time * 1000, 3),
+            "output_bytes": recorder.output_bytes,
+        },
+        "requests": stub.requests if stub is not None else None,
+        "http": http_stats,
+    }
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from PIL import Image as PILImage
+import asyncio
+import hashlib
+import random
+import httpx
+
+STUB_URL = "http://celar-stub"
+
+def make_image(width: int, height: int, seed: int, format: str = "PNG") -> bytes:
+    # a gradient with noise on top compresses about as well as a photo
+    rng = random.Random(seed)
+    gradient = PILImage.linear_gradient("L").resize((width, height)).rotate(rng.randrange(360))
+    img = PILImage.merge("RGB", (
+        gradient,
+        PILImage.effect_noise((width, height), rng.randint(20, 60)),
+        gradient.transpose(PILImage.Transpose.FLIP_LEFT_RIGHT),
+    ))
+    buffer = BytesIO()
+    img.save(buffer, format=format)
+    return buffer.getvalue()
+
+class StubServer:
+    # answers the requests the client makes with canned data, used through httpx.MockTransport
+    # so no server (or network) is involved
+    def __init__(self, posts: int = 100, images: int = 10, image_size=(1024, 768),
+                 rendition: str = "original", latency: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.rendition = rendition
+        self.requests = {}
+        if rendition == "display":
+            # what the server sends once its rendition is ready
+            self.images = [make_image(512, 512, seed * 1000 + i, format="WEBP") for i in range(images)]
+            self.content_type = "image/webp"
+        else:
+            self.images = [make_image(*image_size, seed * 1000 + i) for i in range(images)]
+            self.content_type = "image/png"
+        self.etags = [f'"{hashlib.sha256(data).hexdigest()}"' for data in self.images]
+        start = datetime.now(timezone.utc) - timedelta(minutes=posts)
+        self.posts = [
+            {
+                "id": post_id,
+                "author": f"user{post_id % 17}",
+                "content_url": f"/posts/{post_id}/content",
+                "created_at": (start + timedelta(minutes=post_id)).isoformat(),
+                "like_count": post_id % 7,
+                "user_liked": False,
+            }
+            for post_id in range(1, posts + 1)
+        ]
+
+    def transport(self):
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = request.url.path
+        parts = path.strip("/").split("/")
+        route = f"{request.method} {path}"
+        if parts[0] == "posts" and len(parts) == 3:
+            route = f"{request.method} /posts/{{id}}/{parts[2]}"
+        self.requests[route] = self.requests.get(route, 0) + 1
+
+        if route == "GET /details":
+            return httpx.Response(200, json={"demo_mode": False, "version": "stub"})
+        if route == "POST /login":
+            return httpx.Response(200, json={"message": "Login successful", "access_token": "stub", "token_type": "bearer"})
+        if route == "GET /profile":
+            return httpx.Response(200, json={"username": "bench", "software": [], "coins": 0})
+        if route == "GET /posts":
+            limit = int(request.url.params.get("limit", 20))
+            before_id = int(request.url.params.get("before_id", len(self.posts) + 1))
+            page = [post for post in reversed(self.posts) if post["id"] < before_id][:limit]
+            return httpx.Response(200, json=page)
+        if route == "GET /posts/{id}/content":
+            index = int(parts[1]) % len(self.images)
+            headers = {
+                "ETag": self.etags[index],
+                "X-Celar-Rendition": self.rendition,
+                "Cache-Control": "private, max-age=31536000, immutable" if self.rendition == "display" else "private, no-cache",
+            }
+            if request.headers.get("If-None-Match") == self.etags[index]:
+                return httpx.Response(304, headers=headers)
+            return httpx.Response(200, content=self.images[index], headers={**headers, "Content-Type": self.content_type})
+        if route == "POST /posts/{id}/like_toggle":
+            post = self.posts[int(parts[1]) - 1]
+            post["user_liked"] = not post["user_liked"]
+            post["like_count"] += 1 if post["user_liked"] else -1
+            return httpx.Response(200, json={"like_count": post["like_count"], "user_liked": post["user_liked"]})
+        return httpx.Response(404, json={"detail": "Not Found"})
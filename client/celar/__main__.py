@@ -5,127 +5,296 @@ from textual_image.widget import Image
 from textual_fspicker import FileOpen
 from textual.containers import Vertical, VerticalScroll, VerticalGroup, Horizontal
 from textual.screen import Screen
+from textual.css.query import NoMatches
 from datetime import datetime
 from PIL import Image as PILImage
 from PIL import ImageFilter as PILImageFilter
 from io import BytesIO
-import requests
-import base64
+from concurrent.futures import ThreadPoolExecutor
+from .cache import ImageCache
+from .api import CelarClient, PostData, HTTP_TIMEOUT
+import asyncio
+import httpx
+import json
+import time
+import re
+import os
 from importlib.resources import files
 from importlib.metadata import version
 
-CELAR_TOKEN = None
-API_URL = None
 DEMO_MODE = False
-SERVER_DETAILS = {}
-CURRENT_USER = None
 VERSION = version("celar")
+IMAGE_CACHE = ImageCache()
+# how many post images are downloaded at the same time
+IMAGE_CONCURRENCY = 6
+# threads that decode, compose and encode post images, Pillow releases the GIL for most of it
+# so a page of images is processed in parallel on all cores
+IMAGE_WORKERS = os.cpu_count() or 4
+IMAGE_POOL = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="celar-image")
+# the background is blurred at 1/BLUR_SCALE of its size and scaled back up, which looks
+# the same as blurring it at full size for a blur this strong and is a lot cheaper
+BLUR_RADIUS = 20
+BLUR_SCALE = 4
+PAGE_SIZE = 20
+# the server sends a ping every 15 seconds, a stream that stays silent longer is reconnected
+EVENTS_READ_TIMEOUT = 60
+EVENTS_MAX_DELAY = 30
+# most post ids /posts/likes:batch takes at once
+LIKES_BATCH_SIZE = 200
+# distances from the visible area in screen heights, images closer than LOAD_MARGIN are
+# loaded and images further away than UNLOAD_MARGIN are freed again
+LOAD_MARGIN = 1
+UNLOAD_MARGIN = 3
+
+def compose_post_image(img):
+    # resize and fill rest with blurred version of image
+    img.thumbnail((512, 512), PILImage.Resampling.LANCZOS)
+    small = 512 // BLUR_SCALE
+    new_img = (
+        img.resize((small, small), PILImage.Resampling.BOX)
+        .filter(PILImageFilter.GaussianBlur(BLUR_RADIUS / BLUR_SCALE))
+        .resize((512, 512), PILImage.Resampling.BICUBIC)
+    )
+
+    x = (512 - img.width) // 2
+    y = (512 - img.height) // 2
+    new_img.paste(img, (x, y))
+    return new_img
+
+def load_processed_image(data: bytes):
+    img = PILImage.open(BytesIO(data))
+    img.load()
+    return img
+
+def prepare_image(raw: bytes, rendition):
+    # runs in IMAGE_POOL, returns the image to show and its PNG encoding for the cache
+    img = PILImage.open(BytesIO(raw))
+    try:
+        img.seek(0)
+    except (AttributeError, EOFError):
+        pass
+    # the server sends the original until its 512x512 rendition is ready
+    if rendition != "display":
+        # JPEGs can be decoded at a fraction of their size, still at least 512x512
+        img.draft("RGB", (512, 512))
+        img = compose_post_image(img.convert("RGB"))
+    else:
+        img = img.convert("RGB")
+    buffer = BytesIO()
+    # the cache is local, fast compression is worth the slightly bigger files
+    img.save(buffer, format="PNG", compress_level=1)
+    return img, buffer.getvalue()
+
+async def in_image_pool(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(IMAGE_POOL, func, *args)
+
+async def fetch_post_image(api: CelarClient, slots: asyncio.Semaphore, post_id, content_url: str):
+    cache_key = IMAGE_CACHE.key(api.base_url, post_id)
+    cached_meta, cached_raw, cached_processed = await asyncio.to_thread(IMAGE_CACHE.get, cache_key) or ({}, None, None)
+    if cached_processed and IMAGE_CACHE.is_fresh(cached_meta):
+        return await in_image_pool(load_processed_image, cached_processed)
+    
+    # fetch image bytes separately from the feed listing
+    headers = {}
+    if cached_raw and cached_meta.get("etag"):
+        headers["If-None-Match"] = cached_meta["etag"]
+    async with slots:
+        response = await api.get(content_url, params={"rendition": "display"}, headers=headers)
+    if response.status_code not in (200, 304):
+        response.raise_for_status()
+    cache_control = response.headers.get("Cache-Control", "")
+    max_age = re.search(r"max-age=(\d+)", cache_control)
+    meta = {
+        "etag": response.headers.get("ETag"),
+        "expires": 0
+    }
+    if max_age and "no-cache" not in cache_control:
+        meta["expires"] = time.time() + int(max_age.group(1))
+    
+    if response.status_code == 304 and cached_raw:
+        meta["rendition"] = cached_meta.get("rendition")
+        if cached_processed:
+            await asyncio.to_thread(IMAGE_CACHE.put, cache_key, meta)
+            return await in_image_pool(load_processed_image, cached_processed)
+        raw = cached_raw
+    else:
+        meta["rendition"] = response.headers.get("X-Celar-Rendition")
+        raw = response.content
+    
+    img, processed = await in_image_pool(prepare_image, raw, meta["rendition"])
+    await asyncio.to_thread(IMAGE_CACHE.put, cache_key, meta, raw, processed)
+    return img
 
 class Post(VerticalGroup):
-    def __init__(self, post_id, author: str, content: bytes, created_at: str, **kwargs):
+    def __init__(self, post_id, author: str, content_url: str, created_at: str, like_count: int, user_liked: bool, **kwargs):
         super().__init__(**kwargs)
         self.add_class("post")
         self.post_id = post_id
         self.author = author
+        self.content_url = content_url
         created_dt = datetime.fromisoformat(created_at)
         self.created_at = created_dt.strftime("%B %d, %Y %H:%M UTC")
-        img_data = base64.b64decode(content)
-        self.img = PILImage.open(BytesIO(img_data))
-        try:
-            self.img.seek(0)
-        except (AttributeError, EOFError):
-            pass
-        self.img = self.img.convert("RGB")
-        # resize and fill rest with blurred version of image
-        self.img.thumbnail((512, 512), PILImage.Resampling.LANCZOS)
-        blurred_bg = self.img.copy().resize((512, 512), PILImage.Resampling.LANCZOS).filter(PILImageFilter.GaussianBlur(20))
-
-        new_img = PILImage.new("RGB", (512, 512))
-        new_img.paste(blurred_bg, (0, 0))
-
-        x = (512 - self.img.width) // 2
-        y = (512 - self.img.height) // 2
-        new_img.paste(self.img, (x, y))
-
-        self.img = new_img
+        # likes come with the feed page
+        self.like_count = like_count
+        self.user_liked = user_liked
+        self.pending_likes = 0
+        self.like_lock = asyncio.Lock()
+        # None, "loading" or "shown", images are only loaded near the visible area
+        self.image_state = None
         
-        # get likes
-        self.headers = {
-            "Authorization": f"Bearer {CELAR_TOKEN}"
-        }
-        response = requests.get(f"{API_URL}/posts/{post_id}/likes", headers=self.headers)
-        if response.status_code != 200:
-            self.app.notify("An error occured. Try restarting the program.", severity="error")
-            self.button_text = "Could not load likes."
-        else:
-            self.post_likes = response.json()
-                
-            self.button_text = (
-                f"Take coin back ({self.post_likes['like_count']} 🪙)"
-                if self.post_likes["user_liked"]
-                else f"Give it a coin ({self.post_likes['like_count']} 🪙)"
-            )
+    @property
+    def button_text(self):
+        return (
+            f"Take coin back ({self.like_count} 🪙)"
+            if self.user_liked
+            else f"Give it a coin ({self.like_count} 🪙)"
+        )
           
     def compose(self) -> ComposeResult:
         yield Static(self.author, classes="feed-text")
         yield Static(self.created_at, classes="feed-text")
-        yield Image(self.img)
-        if self.author == CURRENT_USER:
+        yield Static("Loading image...", classes="image-placeholder")
+        if self.author == self.app.api.username:
             yield Horizontal(
                 Button(self.button_text, id="like-button", variant="primary", classes="like-button-del"),
                 Button("Delete", id="delete-button", variant="error")
             )
         else:
             yield Button(self.button_text, id="like-button", variant="primary", classes="like-button")
+    
+    def show_image(self):
+        if self.image_state is None:
+            self.image_state = "loading"
+            self.load_image()
+    
+    async def hide_image(self):
+        if self.image_state == "loading":
+            self.workers.cancel_group(self, "image")
+        elif self.image_state == "shown":
+            image = self.query_one(Image)
+            await self.mount(Static("Loading image...", classes="image-placeholder"), before=image)
+            await image.remove()
+        self.image_state = None
+    
+    @work(exclusive=True, group="image")
+    async def load_image(self):
+        placeholder = self.query_one(".image-placeholder", Static)
+        try:
+            img = await fetch_post_image(self.app.api, self.app.image_slots, self.post_id, self.content_url)
+        except (httpx.HTTPError, OSError, PILImage.UnidentifiedImageError):
+            placeholder.update("Could not load image.")
+            self.image_state = None
+            return
+        await self.mount(Image(img), before=placeholder)
+        await placeholder.remove()
+        self.image_state = "shown"
         
     def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "like-button":
-            # toggle like
-            response = requests.post(f"{API_URL}/posts/{self.post_id}/like_toggle", headers=self.headers)
-            if response.status_code != 200:
-                self.app.notify("An error occured. Try restarting the program.", severity="error")
-                self.button_text = "Could not load likes."
-            else:
-                self.post_likes = response.json()
-                
-                self.button_text = (
-                    f"Take coin back ({self.post_likes['like_count']} 🪙)"
-                    if self.post_likes["user_liked"]
-                    else f"Give it a coin ({self.post_likes['like_count']} 🪙)"
-                )
-            
-            button_widget = self.query_one("#like-button", Button)
-            button_widget.label = self.button_text
-            
+            # show the new state right away, the server response corrects it if needed
+            self.user_liked = not self.user_liked
+            self.like_count += 1 if self.user_liked else -1
+            self.query_one("#like-button", Button).label = self.button_text
+            self.toggle_like()
+        elif event.button.id == "delete-button":
+            self.delete_post()
+    
+    @work(group="like")
+    async def toggle_like(self):
+        self.pending_likes += 1
+        # toggles are sent one after another so the last response is the current state
+        async with self.like_lock:
+            try:
+                like = await self.app.api.toggle_like(self.post_id)
+            except httpx.HTTPError:
+                like = None
+        self.pending_likes -= 1
+        if like is None:
+            self.app.notify("An error occured. Try restarting the program.", severity="error")
+            # undo this toggle
+            self.user_liked = not self.user_liked
+            self.like_count += 1 if self.user_liked else -1
+        elif self.pending_likes == 0:
+            self.like_count = like.like_count
+            self.user_liked = like.user_liked
+        self.query_one("#like-button", Button).label = self.button_text
+        
+        feed_screen = self.screen
+        # the event stream brings the new coins, servers without it are asked
+        if isinstance(feed_screen, Feed) and not feed_screen.live:
+            feed_screen.refresh_coins()
+    
+    @work(exclusive=True, group="delete")
+    async def delete_post(self):
+        try:
+            await self.app.api.delete_post(self.post_id)
+            deleted = True
+        except httpx.HTTPError:
+            deleted = False
+        if deleted:
+            self.app.notify("Post deleted successfully")
             feed_screen = self.screen
-            if isinstance(feed_screen, Feed):
+            if isinstance(feed_screen, Feed) and not feed_screen.live:
                 feed_screen.refresh_coins()
-        elif event.button.id == "delete-button":
-            response = requests.delete(
-                f"{API_URL}/posts/{self.post_id}",
-                headers=self.headers
-            )
-            if response.status_code == 200:
-                self.app.notify("Post deleted successfully")
-                feed_screen = self.screen
-                if isinstance(feed_screen, Feed):
-                    feed_screen.refresh_coins()
-                self.remove()
-            else:
-                self.app.notify("Failed to delete post", severity="error")
+            await self.remove()
+        else:
+            self.app.notify("Failed to delete post", severity="error")
         
 class PostScroll(VerticalScroll):
-    def __init__(self, posts: list, **kwargs):
-        super().__init__(**kwargs)
-        self.post_widgets = []
-        for post in posts:
-            self.post_widgets.append(
-                Post(post["id"], post["author"], post["content"], post["created_at"])
+    async def add_posts(self, posts: list, top: bool = False):
+        # new posts from the event stream go above the loaded ones
+        widgets = [
+            Post(
+                post.id,
+                post.author,
+                post.content_url,
+                post.created_at,
+                post.like_count,
+                post.user_liked,
+                id=f"post-{post.id}"
             )
-            
-    def compose(self) -> ComposeResult:
-        for post in self.post_widgets:
-            yield post
+            for post in posts
+        ]
+        if top and self.children:
+            await self.mount_all(widgets, before=0)
+        else:
+            await self.mount_all(widgets)
+    
+    def watch_virtual_size(self) -> None:
+        # new posts were laid out
+        self.call_after_refresh(self.update_visible)
+    
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        self.call_after_refresh(self.update_visible)
+    
+    def on_resize(self) -> None:
+        self.call_after_refresh(self.update_visible)
+    
+    async def update_visible(self):
+        # only keep images of posts around the visible area in memory
+        height = self.size.height
+        top = self.scroll_y
+        bottom = top + height
+        laid_out = True
+        for post in self.query(Post):
+            region = post.virtual_region
+            if not region:
+                laid_out = False
+                continue
+            if region.bottom >= top - height * LOAD_MARGIN and region.y <= bottom + height * LOAD_MARGIN:
+                post.show_image()
+            elif region.bottom < top - height * UNLOAD_MARGIN or region.y > bottom + height * UNLOAD_MARGIN:
+                await post.hide_image()
+        if not laid_out:
+            # the size doesn't always change again once new posts are laid out, so check after the next refresh
+            self.call_after_refresh(self.update_visible)
+
+        # get the next page before the user reaches the end
+        if bottom >= self.virtual_size.height - height * LOAD_MARGIN:
+            feed_screen = self.screen
+            if isinstance(feed_screen, Feed):
+                feed_screen.load_more()
         
 class MultiCheckbox(VerticalScroll):
     def __init__(self, options, **kwargs):
@@ -165,28 +334,32 @@ class NewPost(Screen):
         elif event.button.id == "submit":
             if self.file_path:
                 if self.file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
-                    self.create_post(self.file_path)
+                    button_widget = self.query_one("#submit", Button)
+                    button_widget.disabled = True
+                    button_widget.label = "Posting..."
+                    await self.create_post(self.file_path)
                     self.app.push_screen(Feed())
                 else:
                     self.app.notify("Please select a valid image file.", severity="error")
             else:
                 self.app.notify("Please select an image first.", severity="error")
-                
-    def create_post(self, file_path):
+    
+    @staticmethod
+    def encode_image(file_path):
         img = PILImage.open(file_path)
         img.thumbnail((512, 512), PILImage.Resampling.LANCZOS)
         buffer = BytesIO()
         img.save(buffer, format="PNG")
-        img_bytes = buffer.getvalue()
-        img_b64 = base64.b64encode(img_bytes).decode("utf-8")
-        payload = {
-            "content": img_b64
-        }
-        headers = {
-            "Authorization": f"Bearer {CELAR_TOKEN}"
-        }
-        r = requests.post(f"{API_URL}/post", json=payload, headers=headers)
-        if r.status_code == 200:
+        return buffer.getvalue()
+                
+    async def create_post(self, file_path):
+        img_bytes = await asyncio.to_thread(self.encode_image, file_path)
+        try:
+            await self.app.api.upload_post(img_bytes, "image/png")
+            created = True
+        except httpx.HTTPError:
+            created = False
+        if created:
             self.app.notify("Post successfully created.")
         else:
             self.app.notify("An error occured. Try restarting the program.", severity="error")
@@ -195,52 +368,220 @@ class Feed(Screen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.app.title = "Celar Feed"
-        self.headers = {
-            "Authorization": f"Bearer {CELAR_TOKEN}"
-        }
-        response = requests.get(f"{API_URL}/posts", headers=self.headers)
-        if response.status_code != 200:
-            self.app.notify("An error occured. Try restarting the program.", severity="error")
-        else:
-            self.posts = response.json()
-        if hasattr(self, "posts") and self.posts:
-            self.posts.sort(key=lambda post: post["id"], reverse=True)
-            
-        response = requests.get(f"{API_URL}/profile", headers=self.headers)
-        if response.status_code != 200:
-            self.app.notify("An error occured. Try restarting the program.", severity="error")
-        else:
-            self.coins = response.json()["coins"]
+        self.coins = None
+        self.oldest_id = None
+        self.newest_id = None
+        self.has_more = True
+        self.loading_posts = False
+        self.feed_loaded = False
+        # True while the event stream is connected, coins are polled after likes otherwise
+        self.live = False
+        self.last_event_id = None
+        # posts from the event stream, shown once the user scrolls back up or presses the button
+        self.new_posts = []
     
     def compose(self) -> ComposeResult:
         yield Header()
-        yield Static(f"You received {self.coins} 🪙", classes="feed-text", id="coins-count")
-        if self.posts:
-            yield PostScroll(self.posts)
-        else:
-            yield Static("No posts found.", classes="feed-text")
+        yield Static("Loading coins...", classes="feed-text", id="coins-count")
+        yield Static("Loading posts...", classes="feed-text", id="feed-status")
+        yield Button("New posts", id="new-posts", variant="primary")
+        yield PostScroll()
         yield Button("New post", id="new-post", variant="success")
         yield Footer()
+    
+    def on_mount(self) -> None:
+        self.load_more()
+        self.refresh_coins()
+    
+    def on_screen_suspend(self) -> None:
+        # nothing to update while another screen is shown, the stream resumes where it stopped
+        self.workers.cancel_group(self, "events")
+        self.live = False
+    
+    def on_screen_resume(self) -> None:
+        if self.feed_loaded:
+            self.listen_events()
         
-    def on_button_pressed(self, event: Button.Pressed) -> None:
+    async def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "new-post":
             self.app.push_screen(NewPost())
-            
-    def refresh_coins(self):
-        response = requests.get(f"{API_URL}/profile", headers=self.headers)
-        if response.status_code != 200:
+        elif event.button.id == "new-posts":
+            await self.show_new_posts()
+    
+    def load_more(self):
+        if self.has_more and not self.loading_posts:
+            self.loading_posts = True
+            self.load_posts()
+    
+    @work(group="posts")
+    async def load_posts(self):
+        status = self.query_one("#feed-status", Static)
+        try:
+            posts = await self.app.api.posts(PAGE_SIZE, before_id=self.oldest_id)
+        except httpx.HTTPError:
             self.app.notify("An error occured. Try restarting the program.", severity="error")
-        else:
-            self.coins = response.json()["coins"]
-            
+            if self.oldest_id is None:
+                status.update("Could not load posts.")
+            self.loading_posts = False
+            return
+        self.has_more = len(posts) == PAGE_SIZE
+        if posts:
+            self.oldest_id = posts[-1].id
+            if self.newest_id is None:
+                self.newest_id = posts[0].id
+            status.display = False
+            await self.query_one(PostScroll).add_posts(posts)
+        elif self.oldest_id is None:
+            status.update("No posts found.")
+        self.loading_posts = False
+        # the stream covers the loaded posts, so it is restarted with the new oldest one
+        if posts or not self.feed_loaded:
+            self.feed_loaded = True
+            self.listen_events()
+    
+    @work(exclusive=True, group="coins")
+    async def refresh_coins(self):
+        try:
+            profile = await self.app.api.profile()
+        except httpx.HTTPError:
+            self.app.notify("An error occured. Try restarting the program.", severity="error")
+            return
+        self.show_coins(profile.coins)
+    
+    def show_coins(self, coins: int):
+        self.coins = coins
         coins_text = self.query_one("#coins-count", Static)
-        coins_text.content = f"You received {self.coins} 🪙"
+        coins_text.update(f"You received {self.coins} 🪙")
+    
+    def find_post(self, post_id):
+        try:
+            return self.query_one(PostScroll).get_child_by_id(f"post-{post_id}", Post)
+        except NoMatches:
+            return None
+    
+    @work(exclusive=True, group="events")
+    async def listen_events(self):
+        # like counts of the loaded posts, the user's coins and new or deleted posts are pushed by
+        # the server instead of being polled, a dropped stream resumes after the last event it got
+        delay = 1
+        try:
+            while True:
+                headers = {}
+                if self.last_event_id is not None:
+                    headers["Last-Event-ID"] = self.last_event_id
+                try:
+                    async with self.app.api.stream(
+                        "GET",
+                        "/events",
+                        params={"posts_from": self.oldest_id or 0},
+                        headers=headers,
+                        timeout=httpx.Timeout(HTTP_TIMEOUT, read=EVENTS_READ_TIMEOUT)
+                    ) as response:
+                        # older servers and expired sessions, coins are refreshed after likes instead
+                        if response.status_code in (401, 404):
+                            return
+                        if response.status_code == 200:
+                            self.live = True
+                            delay = 1
+                            await self.read_events(response)
+                except httpx.HTTPError:
+                    pass
+                self.live = False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, EVENTS_MAX_DELAY)
+        finally:
+            self.live = False
+    
+    async def read_events(self, response: httpx.Response):
+        # server-sent events, fields until an empty line, lines starting with ":" are pings
+        kind, data, event_id = None, [], None
+        async for line in response.aiter_lines():
+            if line:
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "event":
+                    kind = value
+                elif field == "data":
+                    data.append(value)
+                elif field == "id":
+                    event_id = value
+                continue
+            if kind is not None and data:
+                await self.apply_event(kind, json.loads("\n".join(data)))
+            if event_id is not None:
+                self.last_event_id = event_id
+            kind, data, event_id = None, [], None
+    
+    async def apply_event(self, kind: str, data: dict):
+        if kind == "like":
+            post = self.find_post(data["post_id"])
+            # while the user's own toggle is in flight its response is newer
+            if post is not None and post.pending_likes == 0:
+                post.like_count = data["like_count"]
+                post.query_one("#like-button", Button).label = post.button_text
+            for pending in self.new_posts:
+                if pending.id == data["post_id"]:
+                    pending.like_count = data["like_count"]
+        elif kind == "coins":
+            self.show_coins(data["coins"])
+        elif kind == "post":
+            await self.add_new_post(PostData.from_json(data))
+        elif kind == "delete":
+            self.new_posts = [pending for pending in self.new_posts if pending.id != data["post_id"]]
+            post = self.find_post(data["post_id"])
+            if post is not None:
+                await post.remove()
+        elif kind == "reset":
+            # the server no longer has the events that were missed, load the current state instead
+            await self.resync()
+    
+    async def add_new_post(self, post: PostData):
+        if self.find_post(post.id) is not None or any(pending.id == post.id for pending in self.new_posts):
+            return
+        self.newest_id = max(self.newest_id or 0, post.id)
+        self.new_posts.append(post)
+        # only shown right away at the top, so the posts the user is looking at don't move
+        if self.query_one(PostScroll).scroll_y == 0:
+            await self.show_new_posts()
+        else:
+            button = self.query_one("#new-posts", Button)
+            button.label = f"{len(self.new_posts)} new post{'s' if len(self.new_posts) != 1 else ''}"
+            button.display = True
+    
+    async def show_new_posts(self):
+        posts, self.new_posts = self.new_posts[::-1], []
+        self.query_one("#new-posts", Button).display = False
+        if not posts:
+            return
+        self.query_one("#feed-status", Static).display = False
+        scroll = self.query_one(PostScroll)
+        await scroll.add_posts(posts, top=True)
+        scroll.scroll_home(animate=False)
+    
+    async def resync(self):
+        self.refresh_coins()
+        posts = list(self.query(Post))
+        try:
+            for start in range(0, len(posts), LIKES_BATCH_SIZE):
+                chunk = posts[start:start + LIKES_BATCH_SIZE]
+                likes = await self.app.api.likes([post.post_id for post in chunk])
+                for post in chunk:
+                    like = likes.get(post.post_id)
+                    if like is not None and post.pending_likes == 0:
+                        post.like_count = like.like_count
+                        post.user_liked = like.user_liked
+                        post.query_one("#like-button", Button).label = post.button_text
+            if self.newest_id is not None:
+                for post in reversed(await self.app.api.posts(PAGE_SIZE, after_id=self.newest_id)):
+                    await self.add_new_post(post)
+        except httpx.HTTPError:
+            self.app.notify("Could not refresh the feed.", severity="error")
 
 class MainMenu(Screen):
     def __init__(self, **kwargs):
         global DEMO_MODE
         super().__init__(**kwargs)
-        if SERVER_DETAILS.get("demo_mode", False):
+        if self.app.api.details.demo_mode:
             self.app.notify("Registration is disabled in demo mode.", severity="error")
             DEMO_MODE = True
     
@@ -300,25 +641,21 @@ class LoginMenu(Screen):
     def on_input_changed(self, event: Input.Changed) -> None:
         self.values[str(event.input.id) or ""] = event.input.value
         
-    def login(self, username, password):
-        global CELAR_TOKEN, CURRENT_USER
+    @work(exclusive=True)
+    async def login(self, username, password):
         try:
-            r = requests.post(f"{API_URL}/login", json={
-                "username": username,
-                "password": password
-            })
-        except:
+            await self.app.api.login(username, password)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 401:
+                self.notify("Username or password incorrect.", severity="error")
+            else:
+                self.notify("An error occurred.", severity="error")
+            return
+        except httpx.HTTPError:
             self.notify("Couldn't connect to server.", severity="error")
             return
-        if r.status_code == 200:
-            CELAR_TOKEN = r.json()["access_token"]
-            CURRENT_USER = username
-            self.notify("Login successful.")
-            self.app.push_screen(Feed())
-        elif r.status_code == 401:
-            self.notify("Username or password incorrect.", severity="error")
-        else:
-            self.notify("An error occurred.", severity="error")
+        self.notify("Login successful.")
+        self.app.push_screen(Feed())
             
 class RegisterMenu(Screen):
     def __init__(self):
@@ -364,24 +701,21 @@ class RegisterMenu(Screen):
     def on_input_changed(self, event: Input.Changed) -> None:
         self.values[str(event.input.id) or ""] = event.input.value
         
-    def register(self, username, password, software):
-        global CELAR_TOKEN
+    @work(exclusive=True)
+    async def register(self, username, password, software):
         try:
-            r = requests.post(f"{API_URL}/register", json={
-                "username": username,
-                "password": password,
-                "software": [str(item) for item in software]
-            })
-        except:
+            await self.app.api.register(username, password, [str(item) for item in software])
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 400:
+                self.notify("User already exists.", severity="error")
+            else:
+                self.notify("An error occurred.", severity="error")
+            return
+        except httpx.HTTPError:
             self.app.notify("Couldn't connect to server.", severity="error")
             return
-        if r.status_code == 200:
-            self.notify("Register successful.")
-            self.app.push_screen(LoginMenu())
-        elif r.status_code == 400:
-            self.notify("User already exists.", severity="error")
-        else:
-            self.notify("An error occurred.", severity="error")
+        self.notify("Register successful.")
+        self.app.push_screen(LoginMenu())
 
 class SetApi(Screen):
     def compose(self) -> ComposeResult:
@@ -395,32 +729,25 @@ class SetApi(Screen):
         yield Footer()
     
     def on_input_submitted(self, event: Input.Submitted) -> None:
-        global API_URL, SERVER_DETAILS
-        api_input = self.query_one("#api-url", Input)
-        API_URL = api_input.value
-        try:
-            SERVER_DETAILS = requests.get(f"{API_URL}/details").json()
-        except:
-            self.app.notify("Could not connect to server.", severity="error")
-            return
-        self.app.notify(f"API URL set to: {API_URL}")
-        self.app.push_screen(MainMenu())
+        self.connect()
     
     def on_button_pressed(self, event: Button.Pressed) -> None:
-        global API_URL, SERVER_DETAILS
         if event.button.id == "submit":
-            api_input = self.query_one("#api-url", Input)
-            API_URL = api_input.value
-            try:
-                SERVER_DETAILS = requests.get(f"{API_URL}/details").json()
-            except:
-                self.app.notify("Could not connect to server.", severity="error")
-                return
-            self.app.notify(f"API URL set to: {API_URL}")
-            self.app.push_screen(MainMenu())
+            self.connect()
         elif event.button.id == "exit":
             self.app.exit()
     
+    @work(exclusive=True)
+    async def connect(self):
+        api_input = self.query_one("#api-url", Input)
+        try:
+            await self.app.api.connect(api_input.value)
+        except (httpx.HTTPError, ValueError):
+            self.app.notify("Could not connect to server.", severity="error")
+            return
+        self.app.notify(f"API URL set to: {self.app.api.base_url}")
+        self.app.push_screen(MainMenu())
+    
 class CelarApp(App):
     try:
         css_content = (files("celar") / "celar.tcss").read_text()
@@ -428,11 +755,20 @@ class CelarApp(App):
     except FileNotFoundError:
         CSS_PATH = "celar.tcss"
     BINDINGS = [("d", "toggle_dark", "Toggle dark mode"), ("q", "quit_app", "Quit")]
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.api = CelarClient()
+        self.image_slots = None
 
     def on_mount(self) -> None:
         """Called when the app starts"""
         self.title = "Celar"
+        self.image_slots = asyncio.Semaphore(IMAGE_CONCURRENCY)
         self.push_screen(SetApi())
+    
+    async def on_unmount(self) -> None:
+        await self.api.close()
         
     def action_toggle_dark(self) -> None:
         self.theme = (
@@ -0,0 +1,226 @@
+from dataclasses import dataclass, field
+from typing import Dict, List
+import importlib.util
+import asyncio
+import random
+import httpx
+
+HTTP_TIMEOUT = 30
+# a server that doesn't accept the connection within this is down, no need to wait HTTP_TIMEOUT
+CONNECT_TIMEOUT = 5
+# httpx closes idle connections after 5 seconds by default, which made most requests of someone
+# browsing slower than that pay a new TCP and TLS handshake. Servers close them on their own schedule
+KEEPALIVE_EXPIRY = 60
+MAX_CONNECTIONS = 20
+RETRIES = 2
+RETRY_DELAY = 0.25
+RETRY_MAX_DELAY = 4
+RETRY_STATUSES = (429, 502, 503, 504)
+# HTTP/2 needs the h2 package (pip install "celar[http2]"), servers without it are spoken to in HTTP/1.1
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+@dataclass
+class ServerDetails:
+    demo_mode: bool
+    version: str
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(data.get("demo_mode", False), data.get("version", ""))
+
+@dataclass
+class PostData:
+    id: int
+    author: str
+    content_url: str
+    created_at: str
+    like_count: int
+    user_liked: bool
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(data["id"], data["author"], data["content_url"], data["created_at"],
+                   data["like_count"], data["user_liked"])
+
+@dataclass
+class LikeState:
+    like_count: int
+    user_liked: bool
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(data["like_count"], data["user_liked"])
+
+@dataclass
+class Profile:
+    username: str
+    coins: int
+    software: List[str] = field(default_factory=list)
+    # servers without follows don't send these
+    followers: int = 0
+    following: int = 0
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(data["username"], data["coins"], data.get("software", []),
+                   data.get("followers", 0), data.get("following", 0))
+
+def json_body(response: httpx.Response):
+    response.raise_for_status()
+    return response.json()
+
+class CelarClient:
+    # one pooled keep-alive session to the server for every screen. GETs are retried with backoff
+    # and identical ones that are in flight at the same time share one request, other methods are
+    # only retried if they never reached the server. Typed methods raise httpx.HTTPStatusError for
+    # error responses and other httpx.HTTPError subclasses if the server can't be reached
+    def __init__(self, base_url: str = None, retries: int = RETRIES, transport: httpx.AsyncBaseTransport = None):
+        self.base_url = base_url
+        self.token = None
+        self.username = None
+        self.details = None
+        self.retries = retries
+        self.http2 = HTTP2 and transport is None
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS,
+                                keepalive_expiry=KEEPALIVE_EXPIRY),
+            http2=self.http2,
+            transport=transport,
+        )
+        self._in_flight = {}
+        self._requests = 0
+        self._retries = 0
+        self._deduplicated = 0
+
+    @property
+    def auth_headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    async def request(self, method: str, path: str, retry: bool = None, headers: dict = None, **kwargs) -> httpx.Response:
+        # returns error responses as well, retry defaults to True for GET
+        if retry is None:
+            retry = method in ("GET", "HEAD")
+        headers = {**self.auth_headers, **(headers or {})}
+        attempt = 0
+        while True:
+            self._requests += 1
+            try:
+                response = await self.http.request(method, self.url(path), headers=headers, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # the request was never sent, safe to repeat for any method
+                if attempt >= self.retries:
+                    raise
+                delay = None
+            except httpx.TransportError:
+                if not retry or attempt >= self.retries:
+                    raise
+                delay = None
+            else:
+                if not retry or response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                delay = self._retry_after(response)
+            if delay is None:
+                delay = min(RETRY_DELAY * 2 ** attempt, RETRY_MAX_DELAY) * random.uniform(0.5, 1.5)
+            attempt += 1
+            self._retries += 1
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_after(response: httpx.Response):
+        try:
+            return min(float(response.headers["Retry-After"]), RETRY_MAX_DELAY)
+        except (KeyError, ValueError):
+            return None
+
+    async def get(self, path: str, params: dict = None, headers: dict = None) -> httpx.Response:
+        # callers asking for the same thing while it loads get the same response, a cancelled
+        # caller (e.g. an image scrolled out of view) doesn't cancel it for the others
+        key = (
+            self.base_url, self.token, path,
+            tuple(sorted((params or {}).items())), tuple(sorted((headers or {}).items())),
+        )
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.request("GET", path, params=params, headers=headers))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._request_done(key, done))
+        else:
+            self._deduplicated += 1
+        return await asyncio.shield(task)
+
+    def _request_done(self, key, task: asyncio.Future):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # nobody may be waiting for it anymore
+        if not task.cancelled():
+            task.exception()
+
+    def stream(self, method: str, path: str, headers: dict = None, **kwargs):
+        # not retried, the caller reconnects
+        return self.http.stream(method, self.url(path), headers={**self.auth_headers, **(headers or {})}, **kwargs)
+
+    async def connect(self, base_url: str) -> ServerDetails:
+        self.base_url = base_url.rstrip("/")
+        self.token = None
+        self.username = None
+        self.details = ServerDetails.from_json(json_body(await self.get("/details")))
+        return self.details
+
+    async def register(self, username: str, password: str, software: List[str]):
+        json_body(await self.request("POST", "/register", json={
+            "username": username,
+            "password": password,
+            "software": software
+        }))
+
+    async def login(self, username: str, password: str):
+        # repeating a login is harmless, so it is retried when the server is busy hashing passwords
+        response = await self.request("POST", "/login", retry=True, json={
+            "username": username,
+            "password": password
+        })
+        self.token = json_body(response)["access_token"]
+        self.username = username
+
+    async def profile(self, username: str = None) -> Profile:
+        path = f"/profile/{username}" if username else "/profile"
+        return Profile.from_json(json_body(await self.get(path)))
+
+    async def posts(self, limit: int, before_id: int = None, after_id: int = None) -> List[PostData]:
+        params = {"limit": limit}
+        if before_id is not None:
+            params["before_id"] = before_id
+        if after_id is not None:
+            params["after_id"] = after_id
+        return [PostData.from_json(post) for post in json_body(await self.get("/posts", params))]
+
+    async def likes(self, post_ids: List[int]) -> Dict[int, LikeState]:
+        # only reads, so it is retried like a GET
+        response = await self.request("POST", "/posts/likes:batch", retry=True, json={"post_ids": post_ids})
+        return {int(post_id): LikeState.from_json(like) for post_id, like in json_body(response).items()}
+
+    async def toggle_like(self, post_id: int) -> LikeState:
+        return LikeState.from_json(json_body(await self.request("POST", f"/posts/{post_id}/like_toggle")))
+
+    async def upload_post(self, content: bytes, content_type: str) -> int:
+        response = await self.request("POST", "/post/upload", content=content, headers={"Content-Type": content_type})
+        return json_body(response)["id"]
+
+    async def delete_post(self, post_id: int):
+        json_body(await self.request("DELETE", f"/posts/{post_id}"))
+
+    def stats(self) -> dict:
+        return {
+            "requests": self._requests,
+            "retries": self._retries,
+            "deduplicated": self._deduplicated,
+            "in_flight": len(self._in_flight),
+            "http2": self.http2,
+        }
+
+    async def close(self):
+        await self.http.aclose()
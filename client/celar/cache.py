@@ -0,0 +1,92 @@
+from platformdirs import user_cache_dir
+import threading
+import hashlib
+import json
+import time
+import os
+
+CACHE_DIR = os.path.join(user_cache_dir("celar"), "images")
+CACHE_SIZE = 200 * 1024 * 1024
+
+class ImageCache:
+    # on disk LRU cache, every entry has the raw download, the processed image and some metadata
+    def __init__(self, root: str = CACHE_DIR, max_size: int = CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = sum(
+            entry.stat().st_size for entry in os.scandir(root) if entry.is_file()
+        )
+
+    def key(self, server: str, post_id) -> str:
+        return hashlib.sha256(f"{server}|{post_id}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str, kind: str) -> str:
+        return os.path.join(self.root, f"{key}.{kind}")
+
+    def get(self, key: str):
+        # returns (metadata, raw bytes, processed bytes) or None
+        try:
+            with open(self._path(key, "json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(self._path(key, "raw"), "rb") as f:
+                raw = f.read()
+            processed = None
+            if os.path.exists(self._path(key, "png")):
+                with open(self._path(key, "png"), "rb") as f:
+                    processed = f.read()
+        except (OSError, ValueError):
+            return None
+        self.touch(key)
+        return meta, raw, processed
+
+    def is_fresh(self, meta: dict) -> bool:
+        return meta.get("expires", 0) > time.time()
+
+    def put(self, key: str, meta: dict, raw: bytes = None, processed: bytes = None):
+        files = [("json", json.dumps(meta).encode("utf-8"))]
+        if raw is not None:
+            files.append(("raw", raw))
+        if processed is not None:
+            files.append(("png", processed))
+        with self._lock:
+            for kind, data in files:
+                path = self._path(key, kind)
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._size += len(data) - old_size
+            self._evict()
+
+    def touch(self, key: str):
+        now = time.time()
+        for kind in ("json", "raw", "png"):
+            try:
+                os.utime(self._path(key, kind), (now, now))
+            except OSError:
+                pass
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+        entries = {}
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            key = entry.name.split(".")[0]
+            mtime, size, paths = entries.get(key, (0, 0, []))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [entry.path])
+        # least recently used entries first
+        for mtime, size, paths in sorted(entries.values()):
+            if self._size <= self.max_size:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size -= size
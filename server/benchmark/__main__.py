@@ -0,0 +1,95 @@
+from datetime import datetime
+import argparse
+import asyncio
+import json
+import sys
+import os
+
+# the server modules are imported as siblings, like main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from .seed import seed
+from .load import SCENARIOS, run, compare
+
+def parse_size(value: str):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Seed synthetic data and load test the Celar server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="fill DATA_DIR/database.db and DATA_DIR/blobs with synthetic data")
+    seed_parser.add_argument("--data-dir", default="bench-data")
+    seed_parser.add_argument("--users", type=int, default=1000)
+    seed_parser.add_argument("--posts", type=int, default=5000)
+    seed_parser.add_argument("--likes", type=int, default=50000)
+    seed_parser.add_argument("--images", type=int, default=20, help="distinct images shared by the posts")
+    seed_parser.add_argument("--image-size", type=parse_size, default=(1024, 768), help="WIDTHxHEIGHT")
+    seed_parser.add_argument("--no-renditions", action="store_true", help="skip rendering display/preview images")
+    seed_parser.add_argument("--rounds", type=int, default=int(os.environ.get("CELAR_BCRYPT_ROUNDS", "12")), help="bcrypt cost of the seeded passwords")
+    seed_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = commands.add_parser("run", help="load test the endpoints and write the results as JSON")
+    run_parser.add_argument("--data-dir", default="bench-data")
+    run_parser.add_argument("--target", choices=["inprocess", "uvicorn"], default="inprocess",
+                            help="call the app in this process or through a uvicorn started on --port")
+    run_parser.add_argument("--url", help="benchmark an already running server instead, it must use seeded data")
+    run_parser.add_argument("--port", type=int, default=8955)
+    run_parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    run_parser.add_argument("--concurrency", type=int, default=50)
+    run_parser.add_argument("--login-concurrency", type=int, default=8)
+    run_parser.add_argument("--duration", type=float, default=10.0, help="seconds per endpoint")
+    run_parser.add_argument("--requests", type=int, help="stop an endpoint after this many requests")
+    run_parser.add_argument("--sessions", type=int, default=20, help="seeded users to log in and spread requests over")
+    run_parser.add_argument("--accept-encoding", help="Accept-Encoding header to send, e.g. identity to turn compression off")
+    run_parser.add_argument("--endpoint", action="append", choices=list(SCENARIOS), help="only run these endpoints (repeatable)")
+    run_parser.add_argument("--output", help="results file, defaults to bench-results/<timestamp>.json")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        counts = seed(
+            args.data_dir, users=args.users, posts=args.posts, likes=args.likes, images=args.images,
+            image_size=args.image_size, renditions=not args.no_renditions, rounds=args.rounds, random_seed=args.seed
+        )
+        print(f"{args.data_dir}: {counts['users']} users, {counts['posts']} posts, {counts['post_likes']} likes")
+
+    elif args.command == "run":
+        output = os.path.abspath(args.output or os.path.join("bench-results", f"{datetime.now():%Y%m%d-%H%M%S}.json"))
+        report = asyncio.run(run(
+            "url" if args.url else args.target, args.data_dir, args.endpoint or list(SCENARIOS),
+            concurrency=args.concurrency, duration=args.duration, max_requests=args.requests,
+            login_concurrency=args.login_concurrency, sessions=args.sessions,
+            url=args.url, port=args.port, workers=args.workers, accept_encoding=args.accept_encoding
+        ))
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"{'endpoint':30} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'bytes':>9} {'cpu ms':>7} {'errors':>7}")
+        for name, result in report["results"].items():
+            latency = result["latency_ms"]
+            print(
+                f"{name:30} {result['throughput']:>9} {latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9} "
+                f"{result['bytes_per_request']!s:>9} {result['cpu_ms_per_request']!s:>7} {result['errors']:>7}"
+            )
+        print(f"Saved to {output}")
+
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows, regressed = compare(old, new, args.threshold)
+        print(f"{'endpoint':30} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'bytes':>8} {'cpu':>8}")
+        for row in rows:
+            print(f"{row[0]:30} {row[1]:>8} {row[2]:>8} {row[3]:>8} {row[4]:>8} {row[5]:>8} {row[6]:>8}")
+        sys.exit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    main()
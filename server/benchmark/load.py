@@ -0,0 +1,267 @@
+from contextlib import asynccontextmanager, AsyncExitStack
+from datetime import datetime, timezone
+from .seed import PASSWORD
+import subprocess
+import asyncio
+import random
+import httpx
+import time
+import sys
+import os
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> function(client, context) returning the response of one request
+async def get_posts(client, ctx):
+    before_id = random.randint(ctx["first_id"] + 1, ctx["last_id"] + 1)
+    return await client.get("/posts", params={"limit": 20, "before_id": before_id}, headers=random.choice(ctx["headers"]))
+
+async def get_posts_ranked(client, ctx):
+    return await client.get("/posts", params={"limit": 20, "order": "ranked"}, headers=random.choice(ctx["headers"]))
+
+async def get_likes(client, ctx):
+    post_id = random.randint(ctx["first_id"], ctx["last_id"])
+    return await client.get(f"/posts/{post_id}/likes", headers=random.choice(ctx["headers"]))
+
+async def toggle_like(client, ctx):
+    post_id = random.randint(ctx["first_id"], ctx["last_id"])
+    return await client.post(f"/posts/{post_id}/like_toggle", headers=random.choice(ctx["headers"]))
+
+async def get_profile(client, ctx):
+    return await client.get("/profile", headers=random.choice(ctx["headers"]))
+
+async def get_users(client, ctx):
+    return await client.get("/users", params={"limit": 200}, headers=random.choice(ctx["headers"]))
+
+async def login(client, ctx):
+    return await client.post("/login", json={"username": random.choice(ctx["usernames"]), "password": PASSWORD})
+
+SCENARIOS = {
+    "GET /posts": get_posts,
+    "GET /posts?order=ranked": get_posts_ranked,
+    "GET /posts/{id}/likes": get_likes,
+    "POST /posts/{id}/like_toggle": toggle_like,
+    "GET /profile": get_profile,
+    "GET /users": get_users,
+    "POST /login": login,
+}
+
+def percentile(sorted_values, p: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, statuses, elapsed: float, downloaded: int = 0, cpu: float = None):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if not (status.isdigit() and 200 <= int(status) < 400)),
+        "statuses": statuses,
+        "duration": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        # response bytes as sent over the wire, i.e. compressed
+        "bytes_per_request": round(downloaded / len(latencies), 1) if latencies else None,
+        "cpu_ms_per_request": round(cpu / len(latencies) * 1000, 3) if latencies and cpu is not None else None,
+        "latency_ms": {
+            "min": ms(latencies[0] if latencies else None),
+            "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+    }
+
+async def run_scenario(client, ctx, scenario, concurrency: int, duration: float, max_requests: int = None, cpu_time=None):
+    # `concurrency` workers send requests back to back until the time or the request budget runs out
+    latencies, statuses = [], {}
+    downloaded = 0
+    deadline = time.perf_counter() + duration
+    remaining = [max_requests]
+
+    async def worker():
+        nonlocal downloaded
+        while time.perf_counter() < deadline:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                response = await scenario(client, ctx)
+                status = str(response.status_code)
+                downloaded += response.num_bytes_downloaded
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    cpu_start = cpu_time() if cpu_time else None
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    cpu = cpu_time() - cpu_start if cpu_start is not None else None
+    return summarize(latencies, statuses, time.perf_counter() - start, downloaded, cpu)
+
+def process_tree_cpu(pid: int):
+    # user + system seconds of a process and its children from /proc, None where there is no /proc
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the fields after the command name, which may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        total = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError, IndexError):
+        return None
+    for child in children:
+        total += process_tree_cpu(child) or 0
+    return total
+
+async def prepare(client, sessions: int):
+    # logs in a few seeded users and finds the range of post ids
+    response = await client.get("/details")
+    response.raise_for_status()
+    usernames = [f"user{i}" for i in range(sessions)]
+    tokens = await asyncio.gather(*[
+        client.post("/login", json={"username": name, "password": PASSWORD}) for name in usernames
+    ])
+    headers = []
+    for name, response in zip(usernames, tokens):
+        if response.status_code != 200:
+            raise RuntimeError(f"Could not log in as {name}: {response.status_code} {response.text}")
+        headers.append({"Authorization": f"Bearer {response.json()['access_token']}"})
+    newest = (await client.get("/posts", params={"limit": 1}, headers=headers[0])).json()
+    oldest = (await client.get("/posts", params={"limit": 1, "after_id": 0}, headers=headers[0])).json()
+    if not newest:
+        raise RuntimeError("The database has no posts, run the seed command first")
+    return {
+        "usernames": usernames,
+        "headers": headers,
+        "first_id": oldest[0]["id"],
+        "last_id": newest[0]["id"],
+    }
+
+@asynccontextmanager
+async def in_process_client(data_dir: str, headers: dict):
+    # imports the app with data_dir as working directory, so it opens the seeded database
+    os.environ.setdefault("CELAR_KEY", "benchmark")
+    os.chdir(data_dir)
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+    import main
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60, headers=headers) as client:
+        try:
+            yield client
+        finally:
+            await main.like_queue.close()
+            await main.database.close()
+            main.hasher.shutdown()
+            if main.image_workers is not None:
+                main.image_workers.shutdown(wait=False, cancel_futures=True)
+
+@asynccontextmanager
+async def http_client(url: str, concurrency: int, headers: dict):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits, headers=headers) as client:
+        yield client
+
+@asynccontextmanager
+async def uvicorn_server(data_dir: str, port: int, workers: int):
+    # starts `uvicorn main:app` on the seeded data and stops it afterwards
+    env = {**os.environ, "CELAR_KEY": os.environ.get("CELAR_KEY", "benchmark")}
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app", "--app-dir", SERVER_DIR,
+            "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"
+        ],
+        cwd=data_dir,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(base_url=url) as client:
+            for _ in range(300):
+                if process.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with status {process.returncode}")
+                try:
+                    await client.get("/details")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn did not start within 30s")
+        yield url, process.pid
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+async def run(target: str, data_dir: str, scenarios, concurrency: int = 50, duration: float = 10.0,
+              max_requests: int = None, login_concurrency: int = 8, sessions: int = 20,
+              url: str = None, port: int = 8955, workers: int = 1, accept_encoding: str = None):
+    # target is "inprocess" (ASGI transport, no network), "uvicorn" (started here) or "url" (already running)
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding is not None else {}
+    # CPU time of the server, in process it includes the load generator
+    cpu_time = None
+    async with AsyncExitStack() as stack:
+        if target == "inprocess":
+            client = await stack.enter_async_context(in_process_client(os.path.abspath(data_dir), headers))
+            cpu_time = time.process_time
+        else:
+            if target == "uvicorn":
+                url, pid = await stack.enter_async_context(uvicorn_server(os.path.abspath(data_dir), port, workers))
+                if process_tree_cpu(pid) is not None:
+                    cpu_time = lambda: process_tree_cpu(pid)
+            client = await stack.enter_async_context(http_client(url, max(concurrency, login_concurrency), headers))
+        ctx = await prepare(client, sessions)
+        results = {}
+        for name in scenarios:
+            # bcrypt bounds login throughput, more concurrency would only measure the queue
+            scenario_concurrency = login_concurrency if name == "POST /login" else concurrency
+            print(f"{name}: {scenario_concurrency} concurrent for {duration}s...", file=sys.stderr)
+            results[name] = await run_scenario(
+                client, ctx, SCENARIOS[name], scenario_concurrency, duration, max_requests, cpu_time
+            )
+            results[name]["concurrency"] = scenario_concurrency
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "target": target if target != "url" else url,
+            "workers": workers if target == "uvicorn" else None,
+            "duration": duration,
+            "max_requests": max_requests,
+            "sessions": sessions,
+            "accept_encoding": client.headers.get("Accept-Encoding"),
+            "posts": [ctx["first_id"], ctx["last_id"]],
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+def compare(old: dict, new: dict, threshold: float = 10.0):
+    # returns printable rows and whether any endpoint got slower (p95) or slower to serve (throughput)
+    rows, regressed = [], False
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            rows.append((name, "new", "", "", "", "", ""))
+            continue
+        change = lambda a, b: (b - a) / a * 100 if a else 0.0
+        # results saved before bytes and CPU were measured don't have them
+        optional = lambda key: f"{change(before[key], result[key]):+.1f}%" if before.get(key) and result.get(key) is not None else ""
+        p50 = change(before["latency_ms"]["p50"] or 0, result["latency_ms"]["p50"] or 0)
+        p95 = change(before["latency_ms"]["p95"] or 0, result["latency_ms"]["p95"] or 0)
+        p99 = change(before["latency_ms"]["p99"] or 0, result["latency_ms"]["p99"] or 0)
+        throughput = change(before["throughput"], result["throughput"])
+        worse = p95 > threshold or throughput < -threshold
+        regressed = regressed or worse
+        rows.append((
+            name, f"{p50:+.1f}%", f"{p95:+.1f}%", f"{p99:+.1f}%", f"{throughput:+.1f}%",
+            optional("bytes_per_request"), optional("cpu_ms_per_request") + ("  REGRESSION" if worse else "")
+        ))
+    return rows, regressed
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from PIL import Image
+from blobs import LocalBlobStore
+from images import render
+from migrations import migrate
+from ranking import rerank
+import random
+import sqlite3
+import bcrypt
+import json
+import os
+
+PASSWORD = "benchmark"
+SOFTWARE = ["vim", "emacs", "vscode", "neovim", "helix", "python", "rust", "go", "linux", "macos", "windows", "docker"]
+
+def make_image(width: int, height: int, seed: int) -> bytes:
+    # a gradient with noise on top compresses about as well as a photo
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient("L").resize((width, height)).rotate(rng.randrange(360))
+    color = Image.merge("RGB", (
+        gradient,
+        Image.effect_noise((width, height), rng.randint(20, 60)),
+        gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+    ))
+    buffer = BytesIO()
+    color.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def seed(data_dir: str, users: int = 1000, posts: int = 5000, likes: int = 50000,
+         images: int = 20, image_size=(1024, 768), renditions: bool = True,
+         rounds: int = 12, random_seed: int = 0):
+    # creates (or adds to) data_dir/database.db and data_dir/blobs the same way the server lays them out
+    rng = random.Random(random_seed)
+    os.makedirs(data_dir, exist_ok=True)
+    blob_store = LocalBlobStore(os.path.join(data_dir, "blobs"))
+    conn = sqlite3.connect(os.path.join(data_dir, "database.db"))
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate(conn)
+    c = conn.cursor()
+
+    # every account gets the same password, so it is hashed once
+    hashed_pw = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+    usernames = [f"user{i}" for i in range(users)]
+    c.executemany(
+        "INSERT OR IGNORE INTO users (username, password, software) VALUES (?, ?, ?)",
+        [(name, hashed_pw, json.dumps(rng.sample(SOFTWARE, rng.randint(1, 4)))) for name in usernames]
+    )
+
+    # a few distinct images shared by all posts, identical uploads share a blob on the server too
+    image_hashes = []
+    for i in range(images):
+        data = make_image(*image_size, seed=random_seed * 1000 + i)
+        digest = blob_store.put(data)
+        image_hashes.append(digest)
+        if renditions:
+            for name, rendition, content_type in render(data):
+                c.execute(
+                    "INSERT OR REPLACE INTO renditions (content_hash, name, rendition_hash, content_type) VALUES (?, ?, ?, ?)",
+                    (digest, name, blob_store.put(rendition), content_type)
+                )
+
+    start = datetime.now(timezone.utc) - timedelta(minutes=posts)
+    c.executemany(
+        "INSERT INTO posts (author, content, content_hash, content_type, created_at) VALUES (?, ?, ?, ?, ?)",
+        [
+            (rng.choice(usernames), b"", rng.choice(image_hashes), "image/png", (start + timedelta(minutes=i)).isoformat())
+            for i in range(posts)
+        ]
+    )
+    c.execute("SELECT MIN(id), MAX(id) FROM posts")
+    first_id, last_id = c.fetchone()
+
+    # the triggers keep like_count and coins in sync, duplicates are ignored. likes are given
+    # between the post's creation and now
+    now = datetime.now(timezone.utc).timestamp()
+    liked = []
+    for _ in range(likes):
+        post_id = rng.randint(first_id, last_id)
+        created = (start + timedelta(minutes=post_id - first_id)).timestamp()
+        liked.append((post_id, rng.choice(usernames), rng.uniform(created, now)))
+    c.executemany("INSERT OR IGNORE INTO post_likes (post_id, username, liked_at) VALUES (?, ?, ?)", liked)
+    rerank(c)
+    conn.commit()
+    counts = {
+        table: c.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("users", "posts", "post_likes")
+    }
+    conn.close()
+    return counts
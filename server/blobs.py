@@ -0,0 +1,125 @@
+from typing import BinaryIO
+from io import BytesIO
+import hashlib
+import tempfile
+import os
+
+class BlobWriter:
+    # collects a blob chunk by chunk, it is only stored once commit() is called
+    def __init__(self, store: "BlobStore"):
+        self.store = store
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self._chunks = []
+
+    def write(self, chunk: bytes):
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+        self._chunks.append(chunk)
+
+    @property
+    def digest(self) -> str:
+        return self.hasher.hexdigest()
+
+    def open(self) -> BinaryIO:
+        # reads back what was written so far
+        return BytesIO(b"".join(self._chunks))
+
+    def commit(self) -> str:
+        return self.store.put(b"".join(self._chunks))
+
+    def abort(self):
+        self._chunks = []
+
+class BlobStore:
+    # content addressed: blobs are stored and looked up by their sha256 hex digest
+    def put(self, data: bytes) -> str:
+        raise NotImplementedError
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def open(self, digest: str) -> BinaryIO:
+        raise NotImplementedError
+
+    def exists(self, digest: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, digest: str):
+        raise NotImplementedError
+
+class LocalBlobWriter(BlobWriter):
+    # streams straight to a temp file next to the final location
+    def __init__(self, store: "LocalBlobStore"):
+        super().__init__(store)
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.root, prefix=".tmp-")
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes):
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+        self._file.write(chunk)
+
+    def open(self) -> BinaryIO:
+        self._file.flush()
+        return open(self.tmp_path, "rb")
+
+    def commit(self) -> str:
+        self._file.close()
+        digest = self.digest
+        path = self.store.path(digest)
+        if os.path.exists(path):
+            os.remove(self.tmp_path)
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.tmp_path, path)
+        return digest
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        if len(digest) != 64 or not all(ch in "0123456789abcdef" for ch in digest):
+            raise ValueError(f"Invalid blob digest: {digest!r}")
+        # sharded as ab/cd/abcd... to keep directories small
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def writer(self) -> LocalBlobWriter:
+        return LocalBlobWriter(self)
+
+    def open(self, digest: str) -> BinaryIO:
+        return open(self.path(digest), "rb")
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def delete(self, digest: str):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
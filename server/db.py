@@ -0,0 +1,315 @@
+from contextlib import contextmanager, asynccontextmanager
+from metrics import QUERY_TIME, CONNECTION_WAIT, WRITE_WAIT, WRITE_BATCH, statement_label, job_label
+import threading
+import aiosqlite
+import asyncio
+import sqlite3
+import queue
+import time
+
+# applied once to every new connection
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -16000,  # in KiB
+    "temp_store": "MEMORY",
+}
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int = 8, timeout: float = 10.0, cached_statements: int = 256):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        for name, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        # pool exhausted, wait for a connection to be released
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._waits += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+        return conn
+
+    def _put(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._get()
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._put(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._created - self._in_use,
+                "acquired": self._acquired,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time, 6),
+                "wait_time_max": round(self._max_wait_time, 6),
+            }
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+class AsyncDatabase:
+    # async access for the server: a pool of read only connections and one writer task
+    # that runs queued write jobs back to back in a single transaction (group commit)
+    def __init__(self, path: str, readers: int = 8, timeout: float = 10.0, batch_size: int = 64,
+                 max_queued: int = 1024, cached_statements: int = 256):
+        self.path = path
+        self.readers = readers
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.cached_statements = cached_statements
+        self._idle = None
+        self._jobs = None
+        self._writer = None
+        self._writer_task = None
+        self._created = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._batches = 0
+        self._written = 0
+        self._failed = 0
+        self._max_batch = 0
+
+    async def _connect(self, **kwargs):
+        conn = await aiosqlite.connect(self.path, cached_statements=self.cached_statements, **kwargs)
+        for name, value in PRAGMAS.items():
+            await conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _start(self):
+        # started on first use so it binds to the running event loop
+        if self._writer_task is None:
+            self._idle = asyncio.LifoQueue()
+            self._jobs = asyncio.Queue(maxsize=self.max_queued)
+            self._writer_task = asyncio.create_task(self._write_loop())
+
+    async def _get(self):
+        self._start()
+        try:
+            return self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        if self._created < self.readers:
+            self._created += 1
+            try:
+                conn = await self._connect()
+                await conn.execute("PRAGMA query_only=1")
+                return conn
+            except Exception:
+                self._created -= 1
+                raise
+        start = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(self._idle.get(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - start
+        self._waits += 1
+        self._wait_time += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+        return conn
+
+    @asynccontextmanager
+    async def reader(self):
+        start = time.perf_counter()
+        conn = await self._get()
+        CONNECTION_WAIT.observe(time.perf_counter() - start)
+        self._in_use += 1
+        self._acquired += 1
+        try:
+            yield conn
+        finally:
+            self._in_use -= 1
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle.put_nowait(conn)
+
+    async def fetchone(self, sql: str, params=(), label: str = None):
+        async with self.reader() as db:
+            start = time.perf_counter()
+            async with db.execute(sql, params) as c:
+                row = await c.fetchone()
+            QUERY_TIME.labels(label or statement_label(sql), "read").observe(time.perf_counter() - start)
+            return row
+
+    async def fetchall(self, sql: str, params=(), label: str = None):
+        async with self.reader() as db:
+            start = time.perf_counter()
+            async with db.execute(sql, params) as c:
+                rows = await c.fetchall()
+            QUERY_TIME.labels(label or statement_label(sql), "read").observe(time.perf_counter() - start)
+            return rows
+
+    async def read(self, func, *args):
+        # runs `await func(connection, *args)` on a reader
+        async with self.reader() as db:
+            start = time.perf_counter()
+            try:
+                return await func(db, *args)
+            finally:
+                QUERY_TIME.labels(job_label(func), "read").observe(time.perf_counter() - start)
+
+    async def write(self, func, *args):
+        # queues `await func(connection, *args)` for the writer, it must not commit itself
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._jobs.put_nowait((func, args, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise PoolTimeout(f"{self.max_queued} writes already queued")
+        return await future
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._jobs.get()]
+            while len(batch) < self.batch_size and not self._jobs.empty():
+                batch.append(self._jobs.get_nowait())
+            try:
+                await self._run_batch(batch)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _run_batch(self, batch):
+        if self._writer is None:
+            self._writer = await self._connect(isolation_level=None)
+        db = self._writer
+        results = []
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            for func, args, future, queued_at in batch:
+                start = time.perf_counter()
+                WRITE_WAIT.observe(start - queued_at)
+                # a failing job only rolls back its own savepoint
+                await db.execute("SAVEPOINT job")
+                try:
+                    results.append((future, True, await func(db, *args)))
+                except Exception as e:
+                    await db.execute("ROLLBACK TO job")
+                    results.append((future, False, e))
+                await db.execute("RELEASE job")
+                QUERY_TIME.labels(job_label(func), "write").observe(time.perf_counter() - start)
+            start = time.perf_counter()
+            await db.execute("COMMIT")
+            QUERY_TIME.labels("commit", "write").observe(time.perf_counter() - start)
+        except BaseException:
+            if db.in_transaction:
+                await db.execute("ROLLBACK")
+            raise
+        self._batches += 1
+        self._max_batch = max(self._max_batch, len(batch))
+        WRITE_BATCH.observe(len(batch))
+        # futures are resolved after the commit so callers never see uncommitted writes
+        for future, ok, value in results:
+            if future.done():
+                continue
+            if ok:
+                self._written += 1
+                future.set_result(value)
+            else:
+                self._failed += 1
+                future.set_exception(value)
+
+    def stats(self):
+        return {
+            "readers": self.readers,
+            "open": self._created,
+            "in_use": self._in_use,
+            "idle": self._created - self._in_use,
+            "acquired": self._acquired,
+            "waits": self._waits,
+            "wait_time_total": round(self._wait_time, 6),
+            "wait_time_max": round(self._max_wait_time, 6),
+            "writes_queued": self._jobs.qsize() if self._jobs is not None else 0,
+            "write_batches": self._batches,
+            "writes": self._written,
+            "writes_failed": self._failed,
+            "write_batch_max": self._max_batch,
+        }
+
+    async def close(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+        while self._idle is not None and not self._idle.empty():
+            await self._idle.get_nowait().close()
+            self._created -= 1
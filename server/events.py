@@ -0,0 +1,185 @@
+from db import AsyncDatabase, PoolTimeout
+import asyncio
+import queries
+import orjson
+import time
+
+LIKES = "like"
+COINS = "coins"
+NEW_POST = "post"
+DELETED_POST = "delete"
+# sent instead of the missed events when a client resumes from an event that was already pruned
+RESET = "reset"
+
+# events a resuming client may have missed before it gets a reset instead
+BACKLOG_LIMIT = 5000
+
+def format_event(event_id: int, kind: str, data: str) -> bytes:
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (event_id, kind.encode(), data.encode())
+
+class Subscription:
+    def __init__(self, username: str, posts_from: int, max_queued: int):
+        self.username = username
+        self.posts_from = posts_from
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.overflowed = False
+
+    def wants(self, kind: str, post_id, username) -> bool:
+        # like counts of the posts the client has loaded, its own coins and every new post
+        if kind == COINS:
+            return username == self.username
+        if kind == NEW_POST:
+            return True
+        return post_id is not None and post_id >= self.posts_from
+
+class EventBus:
+    # changes are written to the events table in the same transaction as the change itself, every
+    # worker process polls the table while it has subscribers and hands new rows to its own streams
+    def __init__(self, database: AsyncDatabase, interval: float = 0.2, retention: float = 300.0,
+                 heartbeat: float = 15.0, max_queued: int = 1000):
+        self.database = database
+        self.interval = interval
+        self.retention = retention
+        self.heartbeat = heartbeat
+        self.max_queued = max_queued
+        self._subscribers = set()
+        self._lock = None
+        self._task = None
+        self._last_id = 0
+        self._last_prune = 0.0
+        self._published = 0
+        self._delivered = 0
+        self._overflows = 0
+        self._polls = 0
+
+    async def publish(self, db, events):
+        # events are (kind, post_id, username, data), call it from a write job so they are
+        # committed (or rolled back) together with the change
+        now = time.time()
+        if now - self._last_prune > self.retention / 10:
+            self._last_prune = now
+            await db.execute(queries.PRUNE_EVENTS, (now - self.retention,))
+        await db.executemany(
+            "INSERT INTO events (kind, post_id, username, data, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(kind, post_id, username, orjson.dumps(data).decode(), now) for kind, post_id, username, data in events]
+        )
+        self._published += len(events)
+
+    async def publish_likes(self, db, like_counts: dict):
+        # new like counts of posts and the new coin balance of their authors
+        post_ids = list(like_counts)
+        async with db.execute(queries.liked_posts_authors(len(post_ids)), post_ids) as c:
+            coins = dict(await c.fetchall())
+        await self.publish(db, [
+            *[(LIKES, post_id, None, {"post_id": post_id, "like_count": count}) for post_id, count in like_counts.items()],
+            *[(COINS, None, username, {"coins": balance}) for username, balance in coins.items()],
+        ])
+
+    async def _add(self, subscription: Subscription):
+        # returns the id of the last event the poller has handed out, later ones reach the subscription
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._task is None:
+                row = await self.database.fetchone("SELECT COALESCE(MAX(id), 0) FROM events", label="events_start")
+                self._last_id = row[0]
+                self._task = asyncio.create_task(self._poll())
+            self._subscribers.add(subscription)
+            return self._last_id
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._subscribers:
+                self._task = None
+                return
+            try:
+                rows = await self.database.fetchall(
+                    queries.EVENTS,
+                    (self._last_id,),
+                    "events"
+                )
+            except PoolTimeout:
+                continue
+            except Exception as e:
+                print(f"Could not read events: {e!r}")
+                continue
+            self._polls += 1
+            for event_id, kind, post_id, username, data in rows:
+                self._last_id = event_id
+                for subscription in self._subscribers:
+                    if subscription.overflowed or not subscription.wants(kind, post_id, username):
+                        continue
+                    try:
+                        subscription.queue.put_nowait((event_id, kind, data))
+                        self._delivered += 1
+                    except asyncio.QueueFull:
+                        # a client that can't keep up is disconnected, it resumes with Last-Event-ID
+                        subscription.overflowed = True
+                        self._overflows += 1
+
+    async def _backlog(self, subscription: Subscription, after_id: int, last_id: int) -> bytes:
+        # the events between the client's last one and the first one the poller hands out
+        if after_id == last_id:
+            return b""
+        first = (await self.database.fetchone("SELECT MIN(id) FROM events", label="events_first"))[0]
+        if after_id > last_id or first is None or first > after_id + 1 or last_id - after_id > BACKLOG_LIMIT:
+            return format_event(last_id, RESET, "{}")
+        rows = await self.database.fetchall(
+            queries.EVENTS_BACKLOG,
+            (after_id, last_id),
+            "events_backlog"
+        )
+        return b"".join(
+            format_event(event_id, kind, data)
+            for event_id, kind, post_id, username, data in rows
+            if subscription.wants(kind, post_id, username)
+        )
+
+    async def stream(self, username: str, posts_from: int, after_id, authorized):
+        # server-sent events for one client, ends when `await authorized()` turns false or the client is too slow
+        subscription = Subscription(username, posts_from, self.max_queued)
+        try:
+            last_id = await self._add(subscription)
+            yield b"retry: 3000\n\n"
+            if after_id is not None:
+                yield await self._backlog(subscription, after_id, last_id)
+            # a busy stream never times out, so the token is also checked between batches
+            checked = time.monotonic()
+            while not subscription.overflowed:
+                try:
+                    events = [await asyncio.wait_for(subscription.queue.get(), self.heartbeat)]
+                except asyncio.TimeoutError:
+                    if not await authorized():
+                        return
+                    checked = time.monotonic()
+                    yield b": ping\n\n"
+                    continue
+                while not subscription.queue.empty():
+                    events.append(subscription.queue.get_nowait())
+                if time.monotonic() - checked >= self.heartbeat:
+                    if not await authorized():
+                        return
+                    checked = time.monotonic()
+                yield b"".join(format_event(*event) for event in events)
+        finally:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "last_id": self._last_id,
+            "polls": self._polls,
+            "published": self._published,
+            "delivered": self._delivered,
+            "overflows": self._overflows,
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,69 @@
+from PIL import Image, ImageFilter
+from io import BytesIO
+
+# magic bytes of the image formats the client can post
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+# bytes sniff_image_type needs, the longest signature is RIFF....WEBP
+SNIFF_SIZE = 12
+
+# name -> edge length of the square rendition
+RENDITIONS = {
+    "display": 512,
+    "preview": 128,
+}
+RENDITION_FORMAT = "WEBP"
+RENDITION_TYPE = "image/webp"
+
+def sniff_image_type(data: bytes):
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def verify_image(file) -> bool:
+    # parses the whole file without decoding the pixels, so uploads that only start like an
+    # image are rejected instead of failing when they are rendered
+    try:
+        with Image.open(file) as img:
+            img.verify()
+    except Exception:
+        # Pillow raises all kinds of errors for broken files
+        return False
+    return True
+
+def compose_square(img: Image.Image, size: int):
+    # fit the image into a square and fill the rest with a blurred version of it
+    fg = img.copy()
+    fg.thumbnail((size, size), Image.Resampling.LANCZOS)
+    blurred_bg = img.resize((size, size), Image.Resampling.LANCZOS).filter(ImageFilter.GaussianBlur(20 * size / 512))
+
+    new_img = Image.new("RGB", (size, size))
+    new_img.paste(blurred_bg, (0, 0))
+
+    x = (size - fg.width) // 2
+    y = (size - fg.height) // 2
+    new_img.paste(fg, (x, y))
+    return new_img
+
+def render(data: bytes):
+    # runs in a worker process, returns [(name, image bytes, content type)]
+    img = Image.open(BytesIO(data))
+    try:
+        img.seek(0)
+    except (AttributeError, EOFError):
+        pass
+    img = img.convert("RGB")
+    renditions = []
+    for name, size in RENDITIONS.items():
+        buffer = BytesIO()
+        compose_square(img, size).save(buffer, format=RENDITION_FORMAT, quality=80)
+        renditions.append((name, buffer.getvalue(), RENDITION_TYPE))
+    return renditions
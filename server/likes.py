@@ -0,0 +1,149 @@
+from db import AsyncDatabase
+from ranking import timestamp
+from metrics import LIKE_EVENTS, LIKE_BATCH
+import queries
+import asyncio
+import time
+
+LIKE = "like"
+UNLIKE = "unlike"
+TOGGLE = "toggle"
+
+class LikeQueue:
+    # collects like events for up to `delay` seconds or `batch_size` events and applies
+    # them in one write job, so a busy post costs one commit per batch instead of per like
+    def __init__(self, database: AsyncDatabase, batch_size: int = 500, delay: float = 0.005, event_bus=None, ranking=None):
+        self.database = database
+        self.event_bus = event_bus
+        self.ranking = ranking
+        self.batch_size = batch_size
+        self.delay = delay
+        self._events = None
+        self._task = None
+        self._batches = 0
+        self._applied = 0
+        self._max_batch = 0
+        self._time_total = 0.0
+
+    def _start(self):
+        if self._task is None:
+            self._events = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, post_id: int, username: str, action: str):
+        # resolves to the like count and the user's like state right after this event
+        self._start()
+        LIKE_EVENTS.labels(action).inc()
+        future = asyncio.get_running_loop().create_future()
+        self._events.put_nowait((post_id, username, action, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._events.get()]
+            deadline = loop.time() + self.delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._events.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            start = time.perf_counter()
+            try:
+                results = await self.database.write(self._apply, batch)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self._batches += 1
+            self._applied += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            LIKE_BATCH.observe(len(batch))
+            self._time_total += time.perf_counter() - start
+            for (*_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _apply(self, db, batch):
+        # runs on the database writer, so the state read here can't change until the commit
+        pairs = list(dict.fromkeys((post_id, username) for post_id, username, _, _ in batch))
+        post_ids = list(dict.fromkeys(post_id for post_id, _ in pairs))
+        now = time.time()
+        async with db.execute(queries.batch_posts(len(post_ids)), post_ids) as c:
+            posts = await c.fetchall()
+        counts = {post_id: like_count for post_id, like_count, _ in posts}
+        created = {post_id: created_at for post_id, _, created_at in posts}
+        async with db.execute(queries.batch_likes(len(pairs)), [value for pair in pairs for value in pair]) as c:
+            # when each existing like was given
+            liked = {(post_id, username): liked_at for post_id, username, liked_at in await c.fetchall()}
+        states = {pair: pair in liked for pair in pairs}
+        original = dict(counts)
+
+        # replay the events in order against the in-memory view
+        results = []
+        for post_id, username, action, _ in batch:
+            if post_id not in counts:
+                results.append({"like_count": 0, "user_liked": False})
+                continue
+            was_liked = states[(post_id, username)]
+            now_liked = not was_liked if action == TOGGLE else action == LIKE
+            states[(post_id, username)] = now_liked
+            counts[post_id] += now_liked - was_liked
+            results.append({"like_count": counts[post_id], "user_liked": now_liked})
+
+        # only the net change per user reaches the table, the triggers update the counters
+        inserts = [pair for pair, state in states.items() if state and pair not in liked and pair[0] in counts]
+        deletes = [pair for pair, state in states.items() if not state and pair in liked]
+        if inserts:
+            await db.executemany(
+                "INSERT OR IGNORE INTO post_likes (post_id, username, liked_at) VALUES (?, ?, ?)",
+                [(*pair, now) for pair in inserts]
+            )
+        if deletes:
+            await db.executemany("DELETE FROM post_likes WHERE post_id = ? AND username = ?", deletes)
+        if self.ranking is not None and (inserts or deletes):
+            await self._rerank(db, inserts, {pair: liked[pair] for pair in deletes}, created, now)
+        changed = {post_id: count for post_id, count in counts.items() if count != original[post_id]}
+        if self.event_bus is not None and changed:
+            await self.event_bus.publish_likes(db, changed)
+        return results
+
+    async def _rerank(self, db, inserts, deletes: dict, created: dict, now: float):
+        # scores move by the coins given and taken back, deletes map to when the coin was given
+        post_ids = list(dict.fromkeys(post_id for post_id, _ in [*inserts, *deletes]))
+        async with db.execute(queries.post_scores(len(post_ids)), post_ids) as c:
+            scores = dict(await c.fetchall())
+        for post_id, _ in inserts:
+            if post_id in scores:
+                scores[post_id] = self.ranking.add(scores[post_id], now)
+        for (post_id, _), liked_at in deletes.items():
+            if post_id in scores:
+                post_created = timestamp(created[post_id])
+                given_at = liked_at if liked_at is not None else post_created
+                scores[post_id] = self.ranking.remove(scores[post_id], given_at, post_created)
+        await db.executemany(
+            "UPDATE post_scores SET score = ? WHERE post_id = ?",
+            [(score, post_id) for post_id, score in scores.items()]
+        )
+
+    def stats(self):
+        return {
+            "queued": self._events.qsize() if self._events is not None else 0,
+            "batches": self._batches,
+            "events": self._applied,
+            "batch_max": self._max_batch,
+            "time_total": round(self._time_total, 6),
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
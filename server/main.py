@@ -1,18 +1,44 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from datetime import datetime, timedelta, timezone
-from jose import jwt, JWTError
+from jose import jwt, JWTError, ExpiredSignatureError
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from db import ConnectionPool, AsyncDatabase, PoolTimeout
+from blobs import LocalBlobStore
+from images import RENDITIONS, SNIFF_SIZE, render, sniff_image_type, verify_image
+from hashing import PasswordHasher, HasherBusy
+from tokens import TokenCache, RevocationList, token_hash
+from likes import LikeQueue, LIKE, UNLIKE, TOGGLE
+from migrations import migrate, recount_counters, check_query_plans
+from metrics import MetricsMiddleware, POSTS_CREATED, POSTS_DELETED
+from responses import CompressionMiddleware, PostJSONCache
+from events import EventBus, NEW_POST, DELETED_POST, COINS
+from ranking import Ranking, rerank
+from timelines import FanoutWorker
+import metrics
+import queries
+import anyio.to_thread
 import uvicorn
+import asyncio
 import sqlite3
-import bcrypt
+import multiprocessing
+import binascii
+import orjson
+import hmac
+import math
+import base64
 import json
+import time
 import sys
 import os
 
 # vars for tokens
 TOKEN_KEY = os.environ.get("CELAR_KEY")
 TOKEN_ALGORITHM = "HS256"
+TOKEN_LIFETIME = timedelta(hours=48)
 DEMO_MODE = "demo" in sys.argv
 VERSION = "0.1.8"
 
@@ -20,82 +46,268 @@ if not TOKEN_KEY:
     print("Please set CELAR_KEY.")
     sys.exit(1)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # blocking work left (file responses, blob writes) runs on this many threads
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADS
+    metrics.remove_dead_processes()
+    # picks up posts queued before a restart
+    fanout.start()
+    yield
+    await fanout.close()
+    await event_bus.close()
+    await like_queue.close()
+    await database.close()
+    if image_workers is not None:
+        image_workers.shutdown(wait=False, cancel_futures=True)
+    hasher.shutdown()
+    metrics.process_exiting()
+
+app = FastAPI(lifespan=lifespan)
+# added last so it wraps compression and records the bytes actually sent
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.environ.get("CELAR_COMPRESS_MIN_SIZE", "1024")))
+app.add_middleware(MetricsMiddleware)
 DB_FILE = "database.db"
+DB_POOL_SIZE = int(os.environ.get("CELAR_DB_POOL_SIZE", "8"))
+DB_BATCH_SIZE = int(os.environ.get("CELAR_DB_BATCH_SIZE", "64"))
+LIKE_BATCH_SIZE = int(os.environ.get("CELAR_LIKE_BATCH_SIZE", "500"))
+LIKE_BATCH_DELAY = float(os.environ.get("CELAR_LIKE_BATCH_DELAY", "5"))
+WORKERS = int(os.environ.get("CELAR_WORKERS", "4"))
+THREADS = int(os.environ.get("CELAR_THREADS", "40"))
+
+BLOB_DIR = os.environ.get("CELAR_BLOB_DIR", "blobs")
+MAX_UPLOAD_SIZE = int(os.environ.get("CELAR_MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))
+IMAGE_WORKERS = int(os.environ.get("CELAR_IMAGE_WORKERS", "2"))
+BCRYPT_ROUNDS = int(os.environ.get("CELAR_BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.environ.get("CELAR_HASH_WORKERS", "2"))
+HASH_QUEUE_SIZE = int(os.environ.get("CELAR_HASH_QUEUE_SIZE", "32"))
+HASH_PROCESSES = os.environ.get("CELAR_HASH_PROCESSES", "0") == "1"
+MAX_ROWID = 2**63 - 1
+TOKEN_CACHE_SIZE = int(os.environ.get("CELAR_TOKEN_CACHE_SIZE", "10000"))
+METRICS_TOKEN = os.environ.get("CELAR_METRICS_TOKEN")
+SEARCH_MAX_SOFTWARE = 10
+FANOUT_CUTOFF = int(os.environ.get("CELAR_FANOUT_CUTOFF", "5000"))
+# more followed authors with too many followers than this are merged in with one query instead of one per author
+TIMELINE_MAX_PULLED = 100
+POST_CACHE_SIZE = int(os.environ.get("CELAR_POST_CACHE_SIZE", "10000"))
+EVENTS_INTERVAL = float(os.environ.get("CELAR_EVENTS_INTERVAL", "200"))
+EVENTS_RETENTION = float(os.environ.get("CELAR_EVENTS_RETENTION", "300"))
+
+# the blocking pool is only used for schema setup and the admin commands
+pool = ConnectionPool(DB_FILE, size=1)
+database = AsyncDatabase(DB_FILE, readers=DB_POOL_SIZE, batch_size=DB_BATCH_SIZE)
+blob_store = LocalBlobStore(BLOB_DIR)
+image_workers = None
+background_tasks = set()
+hasher = PasswordHasher(
+    rounds=BCRYPT_ROUNDS,
+    workers=HASH_WORKERS,
+    max_pending=HASH_QUEUE_SIZE,
+    use_processes=HASH_PROCESSES
+)
+token_cache = TokenCache(max_size=TOKEN_CACHE_SIZE)
+revocations = RevocationList(database, token_cache)
+event_bus = EventBus(database, interval=EVENTS_INTERVAL / 1000, retention=EVENTS_RETENTION)
+ranking = Ranking()
+fanout = FanoutWorker(database, cutoff=FANOUT_CUTOFF)
+like_queue = LikeQueue(
+    database,
+    batch_size=LIKE_BATCH_SIZE,
+    delay=LIKE_BATCH_DELAY / 1000,
+    event_bus=event_bus,
+    ranking=ranking
+)
+post_json = PostJSONCache(max_size=POST_CACHE_SIZE)
 
 def init_db():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    with pool.connection() as conn:
+        migrate(conn)
+
+def migrate_blobs(conn: sqlite3.Connection):
+    # move image data stored inline in posts.content to the blob store
     c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password TEXT NOT NULL,
-            software TEXT
-       ) 
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            author TEXT NOT NULL,
-            content BLOB NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(author) REFERENCES users(username)
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS post_likes (
-            post_id INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            PRIMARY KEY (post_id, username),
-            FOREIGN KEY (post_id) REFERENCES posts(id),
-            FOREIGN KEY (username) REFERENCES users(username)
+    c.execute("SELECT id FROM posts WHERE content_hash IS NULL")
+    post_ids = [row[0] for row in c.fetchall()]
+    for post_id in post_ids:
+        c.execute("SELECT content FROM posts WHERE id=?", (post_id,))
+        img_data = base64.b64decode(c.fetchone()[0])
+        digest = blob_store.put(img_data)
+        c.execute(
+            "UPDATE posts SET content_hash=?, content_type=?, content=? WHERE id=?",
+            (digest, sniff_image_type(img_data), b"", post_id)
         )
-    """)
-    conn.commit()
-    conn.close()
+        conn.commit()
+    return len(post_ids)
     
 init_db()
 
-def get_db():
-    conn = sqlite3.connect(DB_FILE)
+def busy():
+    return HTTPException(status_code=503, detail="Server busy, try again later")
+
+async def db_read(func, *args):
+    try:
+        return await database.read(func, *args)
+    except PoolTimeout:
+        raise busy()
+
+async def db_write(func, *args):
+    try:
+        return await database.write(func, *args)
+    except PoolTimeout:
+        raise busy()
+
+async def fetchone(sql: str, params=(), label: str = None):
+    try:
+        return await database.fetchone(sql, params, label)
+    except PoolTimeout:
+        raise busy()
+
+async def fetchall(sql: str, params=(), label: str = None):
+    try:
+        return await database.fetchall(sql, params, label)
+    except PoolTimeout:
+        raise busy()
+
+async def queue_like(post_id: int, username: str, action: str):
+    try:
+        return await like_queue.submit(post_id, username, action)
+    except PoolTimeout:
+        raise busy()
+
+async def hash_call(func, *args):
     try:
-        yield conn
-    finally:
-        conn.close()
+        return await func(*args)
+    except HasherBusy:
+        raise HTTPException(status_code=429, detail="Too many login attempts, try again later", headers={"Retry-After": "1"})
+
+def run_background(coro):
+    # keeps a reference so the task isn't garbage collected before it finishes
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def verify_blob(blob) -> bool:
+    with blob.open() as f:
+        return verify_image(f)
+
+async def save_post(author: str, content_type: str, blob):
+    now = datetime.now(timezone.utc)
+    created_at = now.isoformat()
+    async def insert(db):
+        c = await db.execute(
+            "INSERT INTO posts (author, content, content_hash, content_type, created_at) VALUES (?, ?, ?, ?, ?)",
+            (author, b"", blob.digest, content_type, created_at)
+        )
+        await db.execute(
+            "INSERT INTO post_scores (post_id, score) VALUES (?, ?)",
+            (c.lastrowid, ranking.base(now.timestamp()))
+        )
+        await db.execute("INSERT INTO fanout_queue (post_id) VALUES (?)", (c.lastrowid,))
+        # blob is committed while the write lock is held so delete_post can't remove it concurrently
+        await anyio.to_thread.run_sync(blob.commit)
+        await event_bus.publish(db, [(NEW_POST, c.lastrowid, author, {
+            "id": c.lastrowid,
+            "author": author,
+            "content_url": f"/posts/{c.lastrowid}/content",
+            "created_at": created_at,
+            "like_count": 0,
+            "user_liked": False,
+        })])
+        return c.lastrowid
+    post_id = await database.write(insert)
+    POSTS_CREATED.inc()
+    fanout.notify()
+    run_background(render_post_image(blob.digest))
+    return post_id
+
+async def render_post_image(content_hash: str):
+    global image_workers
+    if image_workers is None:
+        # spawn instead of fork, the server process is already running threads
+        image_workers = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        data = await anyio.to_thread.run_sync(read_blob, content_hash)
+        renditions = await asyncio.get_running_loop().run_in_executor(image_workers, render, data)
+        await database.write(save_renditions, content_hash, renditions)
+    except Exception as e:
+        print(f"Could not render {content_hash}: {e!r}")
+
+def read_blob(content_hash: str):
+    with blob_store.open(content_hash) as f:
+        return f.read()
+
+async def save_renditions(db, content_hash: str, renditions):
+    # the post may have been deleted while rendering
+    async with db.execute(queries.BLOB_IN_USE, (content_hash,)) as c:
+        if await c.fetchone() is None:
+            return
+    for name, data, content_type in renditions:
+        rendition_hash = await anyio.to_thread.run_sync(blob_store.put, data)
+        await db.execute(
+            "INSERT OR REPLACE INTO renditions (content_hash, name, rendition_hash, content_type) VALUES (?, ?, ?, ?)",
+            (content_hash, name, rendition_hash, content_type)
+        )
+
+async def delete_unused_blob(content_hash: str, db):
+    # blobs are shared between identical uploads, only delete them once nothing references them
+    async with db.execute(queries.BLOB_IN_USE, (content_hash,)) as c:
+        if await c.fetchone() is not None:
+            return
+    async with db.execute("SELECT rendition_hash FROM renditions WHERE content_hash=?", (content_hash,)) as c:
+        rendition_hashes = [row[0] for row in await c.fetchall()]
+    await db.execute("DELETE FROM renditions WHERE content_hash=?", (content_hash,))
+    for rendition_hash in rendition_hashes:
+        async with db.execute(queries.RENDITION_IN_USE, (rendition_hash,)) as c:
+            if await c.fetchone() is None:
+                blob_store.delete(rendition_hash)
+    blob_store.delete(content_hash)
 
 def generate_token(data: dict, expires: timedelta):
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + expires
-    to_encode.update({"exp": int(expire.timestamp())})
+    now = time.time()
+    # iat keeps its fraction so a password change only revokes tokens issued before it
+    to_encode.update({"iat": now, "exp": int(now + expires.total_seconds())})
     return jwt.encode(to_encode, TOKEN_KEY, algorithm=TOKEN_ALGORITHM)
 
-def get_user(authorization: str = Header(...)):
+def get_token(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header")
-    token = authorization.split( )[1]
+    return authorization.split( )[1]
+
+async def get_user(token: str = Depends(get_token)):
     try:
-        payload = jwt.decode(token, TOKEN_KEY, algorithms=[TOKEN_ALGORITHM])
-        username = payload.get("sub")
-        exp = payload.get("exp")
-        if exp:
-            exp = datetime.fromtimestamp(payload["exp"], timezone.utc)
-            if exp < datetime.now(timezone.utc):
-                raise HTTPException(status_code=401, detail="Token expired")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
+        await revocations.sync()
+    except PoolTimeout:
+        raise busy()
+    # verified tokens are cached until they expire, revoking one removes it from the cache
+    key = token_hash(token)
+    username = token_cache.get(key)
+    if username is not None:
         return username
+    try:
+        payload = jwt.decode(token, TOKEN_KEY, algorithms=[TOKEN_ALGORITHM])
+    except ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    username = payload.get("sub")
+    exp = payload.get("exp")
+    if username is None or exp is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if revocations.is_revoked(key, username, payload.get("iat", 0)):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    token_cache.put(key, username, exp)
+    return username
     
-def get_user_coins(username: str, db_cursor: sqlite3.Cursor):
-    db_cursor.execute("""
-        SELECT COUNT(*)
-        FROM post_likes
-        JOIN posts ON post_likes.post_id = posts.id
-        WHERE posts.author = ?
-    """, (username,))
-    coins = db_cursor.fetchone()[0]
-    return coins
+async def get_like_states(db, post_ids: List[int], username: str):
+    likes = {post_id: {"like_count": 0, "user_liked": False} for post_id in post_ids}
+    if not post_ids:
+        return likes
+    async with db.execute(queries.like_states(len(post_ids)), (username, *post_ids)) as c:
+        for post_id, like_count, user_liked in await c.fetchall():
+            likes[post_id] = {"like_count": like_count, "user_liked": bool(user_liked)}
+    return likes
 
 # models
 class UserCreate(BaseModel):
@@ -107,6 +319,10 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
+class PasswordChange(BaseModel):
+    old_password: str
+    new_password: str
+
 class UserOut(BaseModel):
     username: str
     software: List[str]
@@ -117,208 +333,567 @@ class PostCreate(BaseModel):
 class PostOut(BaseModel):
     id: int
     author: str
-    content: bytes
+    content_url: str
     created_at: str
+    like_count: int
+    user_liked: bool
+
+class LikesBatch(BaseModel):
+    post_ids: List[int]
 
 # endpoints
 @app.get("/details")
-def get_details():
+async def get_details():
     return {
         "demo_mode": DEMO_MODE,
         "version": VERSION
     }
 
+@app.get("/stats")
+async def get_stats(current_user: str = Depends(get_user)):
+    return {
+        "db": database.stats(),
+        "likes": like_queue.stats(),
+        "password_hasher": hasher.stats(),
+        "token_cache": token_cache.stats(),
+        "post_json_cache": post_json.stats(),
+        "events": event_bus.stats(),
+        "fanout": fanout.stats(),
+    }
+
+@app.get("/metrics")
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    # for Prometheus, values of all worker processes added up
+    if METRICS_TOKEN and not hmac.compare_digest((authorization or "").encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(content=await anyio.to_thread.run_sync(metrics.collect), media_type=metrics.CONTENT_TYPE)
+
+async def insert_user(db, user: UserCreate, hashed_pw: str):
+    try:
+        await db.execute("INSERT INTO users (username, password, software) VALUES (?, ?, ?)",
+                         (user.username, hashed_pw, json.dumps(user.software)))
+    except sqlite3.IntegrityError:
+        return False
+    return True
+
+async def update_password_hash(db, username: str, hashed_pw: str):
+    await db.execute("UPDATE users SET password=? WHERE username=?", (hashed_pw, username))
+
+async def get_password_hash(username: str):
+    row = await fetchone(queries.PASSWORD_HASH, (username,), "password_hash")
+    return row[0] if row else None
+
 @app.post("/register")
-def register(user: UserCreate, db: sqlite3.Connection = Depends(get_db)):
+async def register(user: UserCreate):
     if DEMO_MODE:
         raise HTTPException(status_code=401, detail="Can't create user account in demo mode.")
-    salt = bcrypt.gensalt()
-    hashed_pw = bcrypt.hashpw(user.password.encode('utf-8'), salt).decode('utf-8')
-    
-    c = db.cursor()
-    c.execute("SELECT username FROM users WHERE username=?", (user.username,))
-    if c.fetchone():
+    # checked before hashing so taken names don't cost a bcrypt round
+    if await fetchone("SELECT 1 FROM users WHERE username=?", (user.username,), "username_taken"):
+        raise HTTPException(status_code=400, detail="Username already exists")
+    hashed_pw = await hash_call(hasher.hash, user.password)
+    if not await db_write(insert_user, user, hashed_pw):
         raise HTTPException(status_code=400, detail="Username already exists")
-    c.execute("INSERT INTO users (username, password, software) VALUES (?, ?, ?)",
-              (user.username, hashed_pw, json.dumps(user.software)))
-    db.commit()
     return {"message": "User registered successfully"}
 
 @app.post("/login")
-def login(user: UserLogin, db: sqlite3.Connection = Depends(get_db)):
-    c = db.cursor()
-    c.execute("SELECT password FROM users WHERE username=?", (user.username,))
-    row = c.fetchone()
-    if not row or not bcrypt.checkpw(user.password.encode('utf-8'), row[0].encode('utf-8')):
+async def login(user: UserLogin):
+    hashed_pw = await get_password_hash(user.username)
+    if not hashed_pw or not await hash_call(hasher.verify, user.password, hashed_pw):
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if hasher.needs_rehash(hashed_pw):
+        # upgrade to the configured cost while we have the plain password
+        try:
+            new_hash = await hasher.hash(user.password)
+            await db_write(update_password_hash, user.username, new_hash)
+        except (HasherBusy, HTTPException):
+            pass
     access_token = generate_token(
         data={"sub": user.username},
-        expires=timedelta(hours=48)
+        expires=TOKEN_LIFETIME
     )
     return {"message": "Login successful", "access_token": access_token, "token_type": "bearer"}
 
+@app.post("/logout")
+async def logout(token: str = Depends(get_token), current_user: str = Depends(get_user)):
+    exp = jwt.get_unverified_claims(token)["exp"]
+    try:
+        await revocations.revoke_token(token_hash(token), current_user, exp)
+    except PoolTimeout:
+        raise busy()
+    return {"message": "Logged out"}
+
+@app.post("/password")
+async def change_password(change: PasswordChange, current_user: str = Depends(get_user)):
+    hashed_pw = await get_password_hash(current_user)
+    if not hashed_pw or not await hash_call(hasher.verify, change.old_password, hashed_pw):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    new_hash = await hash_call(hasher.hash, change.new_password)
+    await db_write(update_password_hash, current_user, new_hash)
+    # log out every session of the user, including this one
+    try:
+        await revocations.revoke_user(current_user, TOKEN_LIFETIME.total_seconds())
+    except PoolTimeout:
+        raise busy()
+    return {"message": "Password changed, please log in again"}
+
+def profile_json(row):
+    return {
+        "username": row[0],
+        "software": json.loads(row[1]),
+        "coins": row[2],
+        "followers": row[3],
+        "following": row[4],
+    }
+
 @app.get("/profile")
-def read_me(current_user: str = Depends(get_user), db: sqlite3.Connection = Depends(get_db)):
-    c = db.cursor()
-    c.execute("SELECT username, software FROM users WHERE username=?", (current_user,))
-    row = c.fetchone()
+async def read_me(current_user: str = Depends(get_user)):
+    row = await fetchone(queries.PROFILE, (current_user,), "profile")
     if not row:
         raise HTTPException(status_code=404, detail="User not found")
-    coins = get_user_coins(current_user, c)
-    return {"username": row[0], "software": json.loads(row[1]), "coins": coins}
+    return profile_json(row)
 
 @app.get("/profile/{username}")
-def read_other(username: str, current_user: str = Depends(get_user), db: sqlite3.Connection = Depends(get_db)):
-    c = db.cursor()
-    c.execute("SELECT username, software FROM users WHERE username=?", (username,))
-    row = c.fetchone()
+async def read_other(username: str, current_user: str = Depends(get_user)):
+    row = await fetchone(queries.PROFILE, (username,), "profile")
     if not row:
         raise HTTPException(status_code=404, detail="User not found")
-    coins = get_user_coins(username, c)
-    return {"username": row[0], "software": json.loads(row[1]), "coins": coins}
+    return profile_json(row)
     
-@app.get("/users")
-def get_users(
+@app.get("/users", response_model=List[UserOut])
+async def get_users(
     current_user: str = Depends(get_user),
-    limit: int = Query(50, ge=1, le=200),
-    db: sqlite3.Connection = Depends(get_db)
+    limit: int = Query(50, ge=1, le=200)
 ):
-    c = db.cursor()
-    c.execute("SELECT username, software FROM users LIMIT ?", (limit,))
-    rows = c.fetchall()
-    users = [
-        {"username": row[0], "software": json.loads(row[1])}
-        for row in rows
-    ]
-    return users
+    rows = await fetchall("SELECT username, software FROM users LIMIT ?", (limit,), "users")
+    return Response(content=users_json(rows), media_type="application/json")
 
-@app.post("/post")
-def create_post(post: PostCreate, author: str = Depends(get_user), db: sqlite3.Connection = Depends(get_db)):
-    created_at = datetime.now(timezone.utc).isoformat()
-    c = db.cursor()
-    c.execute(
-        "INSERT INTO posts (author, content, created_at) VALUES (?, ?, ?)",
-        (author, post.content, created_at)
+def users_json(rows) -> bytes:
+    # software is stored as JSON already, so it is copied into the response as it is
+    users = b",".join(
+        b'{"username":%s,"software":%s}' % (orjson.dumps(username), software.encode("utf-8"))
+        for username, software in rows
     )
-    post_id = c.lastrowid
-    db.commit()
+    return b"[" + users + b"]"
+
+async def search_users(db, prefix: Optional[str], software: List[str], match_all: bool, after: Optional[str], limit: int):
+    # pages in case-insensitive username order, `after` is the last username of the previous page
+    if match_all and len(software) > 1:
+        # walk the users of the least used software and check the others for each of them
+        sizes = []
+        for name in software:
+            async with db.execute(queries.SOFTWARE_SIZE, (name, 10000)) as c:
+                sizes.append(((await c.fetchone())[0], name))
+        software = [name for _, name in sorted(sizes)]
+    sql, params = queries.user_search(prefix, software, match_all, after, limit)
+    async with db.execute(sql, params) as c:
+        return await c.fetchall()
+
+@app.get("/users/search")
+async def search_users_endpoint(
+    current_user: str = Depends(get_user),
+    q: Optional[str] = Query(None, max_length=64),
+    software: List[str] = Query([]),
+    match: str = Query("all", pattern="^(all|any)$"),
+    after: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200)
+):
+    # the same software in a different case is the same filter
+    software = list({name.strip().lower(): name.strip() for name in software if name.strip()}.values())
+    if len(software) > SEARCH_MAX_SOFTWARE:
+        raise HTTPException(status_code=400, detail=f"Too many software filters (max {SEARCH_MAX_SOFTWARE})")
+    rows = await db_read(search_users, q, software, match == "all", after, limit)
+    next_cursor = rows[-1][0] if len(rows) == limit else None
+    return Response(
+        content=b'{"users":%s,"next_cursor":%s}' % (users_json(rows), orjson.dumps(next_cursor)),
+        media_type="application/json"
+    )
+
+async def add_follow(db, follower: str, followee: str):
+    async with db.execute("SELECT fanout_pull FROM users WHERE username=?", (followee,)) as c:
+        row = await c.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="User not found")
+    c = await db.execute(
+        "INSERT OR IGNORE INTO follows (follower, followee, pull, created_at) VALUES (?, ?, ?, ?)",
+        (follower, followee, row[0], time.time())
+    )
+    if c.rowcount > 0 and not row[0]:
+        # the followee's recent posts, so they show up before their next post
+        await db.execute(
+            "INSERT OR IGNORE INTO timelines (username, post_id) SELECT ?, id FROM posts WHERE author = ? ORDER BY id DESC LIMIT ?",
+            (follower, followee, fanout.backfill)
+        )
+
+async def remove_follow(db, follower: str, followee: str):
+    c = await db.execute("DELETE FROM follows WHERE follower=? AND followee=?", (follower, followee))
+    if c.rowcount > 0:
+        await db.execute(
+            queries.UNFOLLOW_TIMELINE,
+            (follower, followee)
+        )
+
+@app.post("/users/{username}/follow")
+async def follow_user(username: str, current_user: str = Depends(get_user)):
+    if username == current_user:
+        raise HTTPException(status_code=400, detail="You can't follow yourself")
+    await db_write(add_follow, current_user, username)
+    return {"message": "User followed"}
+
+@app.delete("/users/{username}/follow")
+async def unfollow_user(username: str, current_user: str = Depends(get_user)):
+    await db_write(remove_follow, current_user, username)
+    return {"message": "User unfollowed"}
+
+@app.post("/post")
+async def create_post(post: PostCreate, author: str = Depends(get_user)):
+    try:
+        img_data = base64.b64decode(post.content, validate=True)
+    except binascii.Error:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+    if len(img_data) > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="Image too large")
+    content_type = sniff_image_type(img_data)
+    if content_type is None:
+        raise HTTPException(status_code=415, detail="Unsupported image type")
+    blob = blob_store.writer()
+    try:
+        await anyio.to_thread.run_sync(blob.write, img_data)
+        if not await anyio.to_thread.run_sync(verify_blob, blob):
+            raise HTTPException(status_code=415, detail="Unsupported image type")
+        post_id = await save_post(author, content_type, blob)
+    except PoolTimeout:
+        blob.abort()
+        raise busy()
+    except BaseException:
+        blob.abort()
+        raise
     return {"message": "Post created", "id": post_id}
 
-@app.get("/posts")
-def get_posts(
+@app.post("/post/upload")
+async def upload_post(request: Request, author: str = Depends(get_user)):
+    request_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if request_type != "application/octet-stream" and not request_type.startswith("image/"):
+        raise HTTPException(status_code=415, detail="Send the image as application/octet-stream or image/*")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="Image too large")
+    
+    blob = blob_store.writer()
+    content_type = None
+    # the start of the body until it is long enough to tell the format, chunks can be tiny
+    head = b""
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if blob.size + len(chunk) > MAX_UPLOAD_SIZE:
+                raise HTTPException(status_code=413, detail="Image too large")
+            if content_type is None:
+                head += chunk
+                if len(head) >= SNIFF_SIZE:
+                    content_type = sniff_image_type(head)
+                    if content_type is None:
+                        raise HTTPException(status_code=415, detail="Unsupported image type")
+            await anyio.to_thread.run_sync(blob.write, chunk)
+        if not head:
+            raise HTTPException(status_code=400, detail="Empty upload")
+        if content_type is None:
+            content_type = sniff_image_type(head)
+        if content_type is None or not await anyio.to_thread.run_sync(verify_blob, blob):
+            raise HTTPException(status_code=415, detail="Unsupported image type")
+        post_id = await save_post(author, content_type, blob)
+    except PoolTimeout:
+        blob.abort()
+        raise busy()
+    except BaseException:
+        blob.abort()
+        raise
+    return {"message": "Post created", "id": post_id}
+
+async def select_posts(db, username: str, limit: int, before_id: Optional[int], after_id: Optional[int]):
+    # keyset pagination on the rowid, newest first
+    if after_id is not None:
+        async with db.execute(
+            queries.FEED_NEWER,
+            (after_id, limit)
+        ) as c:
+            rows = (await c.fetchall())[::-1]
+    else:
+        async with db.execute(
+            queries.FEED_PAGE,
+            (before_id if before_id is not None else MAX_ROWID, limit)
+        ) as c:
+            rows = await c.fetchall()
+    likes = await get_like_states(db, [row[0] for row in rows], username)
+    return rows, likes
+
+async def select_timeline(db, username: str, limit: int, before_id: Optional[int]):
+    # the posts pushed to the user's timeline, merged with the posts of followed authors that have
+    # too many followers to push to (see FanoutWorker), each one a search below before_id
+    before_id = before_id if before_id is not None else MAX_ROWID
+    async with db.execute(queries.PULLED_FOLLOWS, (username,)) as c:
+        pulled = [row[0] for row in await c.fetchall()]
+    sql = queries.HOME_TIMELINE
+    params = [username, before_id, limit]
+    if pulled:
+        branches = [f"SELECT * FROM ({sql})"]
+        if len(pulled) > TIMELINE_MAX_PULLED:
+            branches.append(f"SELECT * FROM ({queries.pulled_authors_posts(len(pulled))})")
+            params += [*pulled, before_id, limit]
+        else:
+            for author in pulled:
+                branches.append(f"SELECT * FROM ({queries.PULLED_AUTHOR_POSTS})")
+                params += [author, before_id, limit]
+        # UNION drops posts pushed before their author crossed the cutoff
+        sql = f"SELECT * FROM ({' UNION '.join(branches)}) ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+    async with db.execute(sql, params) as c:
+        rows = await c.fetchall()
+    likes = await get_like_states(db, [row[0] for row in rows], username)
+    return rows, likes
+
+@app.get("/timeline", response_model=List[PostOut])
+async def get_timeline(
     current_user: str = Depends(get_user),
     limit: int = Query(20, ge=1, le=200),
-    db: sqlite3.Connection = Depends(get_db)
+    before_id: Optional[int] = Query(None, ge=1)
 ):
-    c = db.cursor()
-    c.execute("SELECT id, author, content, created_at FROM posts LIMIT ?", (limit,))
-    rows = c.fetchall()
-    posts = [
-        {
-            "id": row[0],
-            "author": row[1],
-            "content": row[2],
-            "created_at": row[3]
-        }
-        for row in rows
-    ]
-    return posts
+    rows, likes = await db_read(select_timeline, current_user, limit, before_id)
+    return Response(content=post_json.render(rows, likes), media_type="application/json")
 
-@app.post("/posts/{post_id}/like")
-def like_post(post_id: int, current_user: str = Depends(get_user), db: sqlite3.Connection = Depends(get_db)):
-    c = db.cursor()
-    c.execute(
-        "INSERT OR IGNORE INTO post_likes (post_id, username) VALUES (?, ?)",
-        (post_id, current_user)
-    )
-    db.commit()
-    return {"message": "Post liked"}
+async def select_ranked_posts(db, username: str, limit: int, score: float, post_id: int):
+    # keyset pagination on the stored score, which only changes when a post gets or loses a coin
+    async with db.execute(queries.FEED_RANKED, (score, post_id, limit)) as c:
+        ranked = await c.fetchall()
+    rows = [row[:3] for row in ranked]
+    likes = await get_like_states(db, [row[0] for row in rows], username)
+    next_cursor = f"{ranked[-1][3]!r}:{ranked[-1][0]}" if len(ranked) == limit else None
+    return rows, likes, next_cursor
 
-@app.delete("/posts/{post_id}/like")
-def unlike_post(post_id: int, current_user: str = Depends(get_user), db: sqlite3.Connection = Depends(get_db)):
-    c = db.cursor()
-    c.execute(
-        "DELETE FROM post_likes WHERE post_id = ? AND username = ?",
-        (post_id, current_user)
+def parse_cursor(cursor: Optional[str]):
+    # "<score>:<post id>" of the last post of the previous page
+    if cursor is None:
+        return math.inf, MAX_ROWID
+    score, _, post_id = cursor.partition(":")
+    try:
+        return float(score), int(post_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/posts", response_model=List[PostOut])
+async def get_posts(
+    current_user: str = Depends(get_user),
+    limit: int = Query(20, ge=1, le=200),
+    before_id: Optional[int] = Query(None, ge=1),
+    after_id: Optional[int] = Query(None, ge=0),
+    order: str = Query("new", pattern="^(new|ranked)$"),
+    cursor: Optional[str] = Query(None, max_length=64)
+):
+    headers = {}
+    if order == "ranked":
+        if before_id is not None or after_id is not None:
+            raise HTTPException(status_code=400, detail="Use cursor instead of before_id or after_id with order=ranked")
+        score, post_id = parse_cursor(cursor)
+        rows, likes, next_cursor = await db_read(select_ranked_posts, current_user, limit, score, post_id)
+        if next_cursor is not None:
+            headers["X-Celar-Next-Cursor"] = next_cursor
+    else:
+        if cursor is not None:
+            raise HTTPException(status_code=400, detail="cursor only works with order=ranked")
+        if before_id is not None and after_id is not None:
+            raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+        rows, likes = await db_read(select_posts, current_user, limit, before_id, after_id)
+    # serialized after the read connection is back in the pool
+    return Response(content=post_json.render(rows, likes), media_type="application/json", headers=headers)
+
+@app.post("/posts/likes:batch")
+async def get_likes_batch(batch: LikesBatch, current_user: str = Depends(get_user)):
+    if len(batch.post_ids) > 200:
+        raise HTTPException(status_code=400, detail="Too many post ids (max 200)")
+    likes = await db_read(get_like_states, list(dict.fromkeys(batch.post_ids)), current_user)
+    return Response(
+        content=orjson.dumps({str(post_id): like_state for post_id, like_state in likes.items()}),
+        media_type="application/json"
     )
-    db.commit()
-    return {"message": "Like removed"}
 
-@app.delete("/posts/{post_id}")
-def delete_post(
+@app.get("/posts/{post_id}/content")
+async def get_post_content(
     post_id: int,
     current_user: str = Depends(get_user),
-    db: sqlite3.Connection = Depends(get_db)
+    rendition: str = Query("original"),
+    if_none_match: Optional[str] = Header(None)
 ):
-    c = db.cursor()
-    c.execute("SELECT author FROM posts WHERE id=?", (post_id,))
-    row = c.fetchone()
+    if rendition != "original" and rendition not in RENDITIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown rendition, use one of: original, {', '.join(RENDITIONS)}")
+    row = await fetchone(queries.POST_CONTENT, (post_id,), "post_content")
+    if not row:
+        raise HTTPException(status_code=404, detail="Post not found")
+    if row[0] is None:
+        # not moved to the blob store yet
+        content = (await fetchone("SELECT content FROM posts WHERE id=?", (post_id,), "post_content_inline"))[0]
+        img_data = base64.b64decode(content)
+        return Response(content=img_data, media_type=sniff_image_type(img_data) or "application/octet-stream")
+    blob_hash, media_type, served = row[0], row[1] or "application/octet-stream", "original"
+    if rendition != "original":
+        rendition_row = await fetchone(
+            queries.RENDITION,
+            (row[0], rendition),
+            "rendition"
+        )
+        # falls back to the original while the rendition is still being generated
+        if rendition_row:
+            blob_hash, media_type, served = rendition_row[0], rendition_row[1], rendition
+    # blobs are content addressed, so their hash is a strong etag
+    headers = {
+        "X-Celar-Rendition": served,
+        "ETag": f'"{blob_hash}"',
+        "Cache-Control": "private, max-age=31536000, immutable" if served == rendition else "private, no-cache"
+    }
+    if if_none_match and f'"{blob_hash}"' in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    if isinstance(blob_store, LocalBlobStore):
+        return FileResponse(blob_store.path(blob_hash), media_type=media_type, headers=headers)
+    return StreamingResponse(blob_store.open(blob_hash), media_type=media_type, headers=headers)
+
+@app.post("/posts/{post_id}/like")
+async def like_post(post_id: int, current_user: str = Depends(get_user)):
+    await queue_like(post_id, current_user, LIKE)
+    return {"message": "Post liked"}
+
+@app.delete("/posts/{post_id}/like")
+async def unlike_post(post_id: int, current_user: str = Depends(get_user)):
+    await queue_like(post_id, current_user, UNLIKE)
+    return {"message": "Like removed"}
+
+async def remove_post(db, post_id: int, username: str):
+    async with db.execute("SELECT author, content_hash, like_count FROM posts WHERE id=?", (post_id,)) as c:
+        row = await c.fetchone()
     
     if not row:
         raise HTTPException(status_code=404, detail="Post not found")
     
-    if row[0] != current_user:
+    if row[0] != username:
         raise HTTPException(status_code=403, detail="You can only delete your own posts")
     
-    c.execute("DELETE FROM post_likes WHERE post_id=?", (post_id,))
-    c.execute("DELETE FROM posts WHERE id=?", (post_id,))
-    db.commit()
-    
+    await db.execute("DELETE FROM post_likes WHERE post_id=?", (post_id,))
+    await db.execute("DELETE FROM post_scores WHERE post_id=?", (post_id,))
+    await db.execute(queries.DELETED_POST_TIMELINES, (post_id,))
+    await db.execute("DELETE FROM fanout_queue WHERE post_id=?", (post_id,))
+    await db.execute("DELETE FROM posts WHERE id=?", (post_id,))
+    if row[1] is not None:
+        await delete_unused_blob(row[1], db)
+    events = [(DELETED_POST, post_id, username, {"post_id": post_id})]
+    if row[2]:
+        # the author lost the post's coins
+        async with db.execute("SELECT coins FROM users WHERE username=?", (username,)) as c:
+            events.append((COINS, None, username, {"coins": (await c.fetchone())[0]}))
+    await event_bus.publish(db, events)
+
+@app.delete("/posts/{post_id}")
+async def delete_post(post_id: int, current_user: str = Depends(get_user)):
+    await db_write(remove_post, post_id, current_user)
+    POSTS_DELETED.inc()
     return {"message": "Post deleted successfully"}
 
-@app.get("/posts/{post_id}/likes")
-def get_likes(post_id: int, current_user: str = Depends(get_user), db: sqlite3.Connection = Depends(get_db)):
-    c = db.cursor()
-    c.execute(
-        "SELECT COUNT(*) FROM post_likes WHERE post_id=?",
-        (post_id,)
-    )
-    like_count = c.fetchone()[0]
-    c.execute(
-        "SELECT 1 FROM post_likes WHERE post_id=? AND username=?",
-        (post_id, current_user)
-    )
-    user_liked = c.fetchone() is not None
+async def select_like_state(db, post_id: int, username: str):
+    async with db.execute("SELECT like_count FROM posts WHERE id=?", (post_id,)) as c:
+        row = await c.fetchone()
+    like_count = row[0] if row else 0
+    async with db.execute(
+        queries.LIKE_STATE,
+        (post_id, username)
+    ) as c:
+        user_liked = await c.fetchone() is not None
     return {
         "like_count": like_count,
         "user_liked": user_liked
     }
-    
+
+@app.get("/posts/{post_id}/likes")
+async def get_likes(post_id: int, current_user: str = Depends(get_user)):
+    return await db_read(select_like_state, post_id, current_user)
+
 @app.post("/posts/{post_id}/like_toggle")
-def toggle_like(post_id: int, current_user: str = Depends(get_user), db: sqlite3.Connection = Depends(get_db)):
-    c = db.cursor()
-    c.execute(
-        "SELECT 1 FROM post_likes WHERE post_id=? AND username=?",
-        (post_id, current_user)
-    )
-    already_liked = c.fetchone() is not None
-    if already_liked:
-        c.execute(
-            "DELETE FROM post_likes WHERE post_id=? AND username=?",
-            (post_id, current_user)
-        )
-    else:
-        c.execute(
-            "INSERT INTO post_likes (post_id, username) VALUES (?, ?)",
-            (post_id, current_user)
-        )
-        
-    db.commit()
-    
-    c.execute(
-        "SELECT COUNT(*) FROM post_likes WHERE post_id=?",
-        (post_id,)
+async def toggle_like(post_id: int, current_user: str = Depends(get_user)):
+    return await queue_like(post_id, current_user, TOGGLE)
+
+@app.get("/events")
+async def stream_events(
+    token: str = Depends(get_token),
+    current_user: str = Depends(get_user),
+    posts_from: int = Query(0, ge=0),
+    last_event_id: Optional[str] = Header(None)
+):
+    # server-sent events: like counts of posts with an id of at least posts_from, the user's coins
+    # and new or deleted posts. Last-Event-ID resumes after a reconnect
+    claims = jwt.get_unverified_claims(token)
+    key = token_hash(token)
+
+    async def authorized():
+        # checked between events, the client reconnects with its new token
+        try:
+            await revocations.sync()
+        except PoolTimeout:
+            pass
+        return time.time() < claims["exp"] and not revocations.is_revoked(key, current_user, claims.get("iat", 0))
+
+    after_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    return StreamingResponse(
+        event_bus.stream(current_user, posts_from, after_id, authorized),
+        media_type="text/event-stream",
+        # proxies must pass the events on as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
-    like_count = c.fetchone()[0]
-    
-    return {
-        "like_count": like_count,
-        "user_liked": not already_liked
-    }
+
+async def render_missing():
+    rows = await database.fetchall(f"""
+        SELECT DISTINCT content_hash FROM posts
+        WHERE content_hash IS NOT NULL AND (
+            SELECT COUNT(*) FROM renditions WHERE renditions.content_hash = posts.content_hash
+        ) < {len(RENDITIONS)}
+    """)
+    await asyncio.gather(*[render_post_image(row[0]) for row in rows])
+    await database.close()
+    return len(rows)
 
 if __name__ == "__main__":
     import sys
+    if "recount" in sys.argv:
+        with pool.connection() as conn:
+            bad_posts, bad_users = recount_counters(conn.cursor())
+            conn.commit()
+        for post_id, stored, actual in bad_posts:
+            print(f"Post {post_id}: like_count {stored} -> {actual}")
+        for username, stored, actual in bad_users:
+            print(f"User {username}: coins {stored} -> {actual}")
+        print(f"Fixed {len(bad_posts)} post(s) and {len(bad_users)} user(s).")
+        sys.exit(0)
+    if "rerank" in sys.argv:
+        with pool.connection() as conn:
+            ranked = rerank(conn.cursor(), ranking)
+            conn.commit()
+        print(f"Ranked {ranked} post(s).")
+        sys.exit(0)
+    if "migrate-blobs" in sys.argv:
+        with pool.connection() as conn:
+            moved = migrate_blobs(conn)
+            conn.execute("VACUUM")
+        print(f"Moved {moved} post(s) to {BLOB_DIR}.")
+        sys.exit(0)
+    if "render" in sys.argv:
+        rendered = asyncio.run(render_missing())
+        if image_workers is not None:
+            image_workers.shutdown()
+        print(f"Rendered {rendered} image(s).")
+        sys.exit(0)
+    if "check-plans" in sys.argv:
+        with pool.connection() as conn:
+            plans, bad = check_query_plans(conn)
+        for name, plan in plans.items():
+            print(f"{'FULL SCAN' if name in bad else 'ok':9}  {name}: {' / '.join(plan)}")
+        print(f"{len(bad)} of {len(plans)} hot queries need a full scan.")
+        sys.exit(1 if bad else 0)
     if "dev" in sys.argv:
         uvicorn.run("main:app", reload=True, host="127.0.0.1")
     else:
-        uvicorn.run("main:app", host="0.0.0.0", workers=4, port=8954)
\ No newline at end of file
+        uvicorn.run("main:app", host="0.0.0.0", workers=WORKERS, port=8954)
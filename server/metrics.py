@@ -0,0 +1,120 @@
+import os
+
+# every process writes its values to files in this directory and /metrics adds them up, so the
+# numbers cover all uvicorn workers. prometheus_client reads the variable when it is imported
+METRICS_DIR = os.path.abspath(os.environ.get("CELAR_METRICS_DIR", "metrics"))
+os.environ["PROMETHEUS_MULTIPROC_DIR"] = METRICS_DIR
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client import CONTENT_TYPE_LATEST as CONTENT_TYPE
+import time
+import re
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+REQUESTS = Counter("celar_http_requests_total", "Finished requests", ["method", "route", "status"])
+REQUEST_TIME = Histogram("celar_http_request_duration_seconds", "Time until the whole response was sent",
+                         ["method", "route"], buckets=LATENCY_BUCKETS)
+RESPONSE_SIZE = Histogram("celar_http_response_size_bytes", "Response body size",
+                          ["method", "route"], buckets=SIZE_BUCKETS)
+IN_PROGRESS = Gauge("celar_http_requests_in_progress", "Requests being handled", multiprocess_mode="livesum")
+
+QUERY_TIME = Histogram("celar_db_query_duration_seconds", "Time a statement or read/write job took on its connection",
+                       ["label", "kind"], buckets=QUERY_BUCKETS)
+CONNECTION_WAIT = Histogram("celar_db_connection_wait_seconds", "Time to get a read connection from the pool",
+                            buckets=QUERY_BUCKETS)
+WRITE_WAIT = Histogram("celar_db_write_wait_seconds", "Time a write job was queued before the writer ran it",
+                       buckets=QUERY_BUCKETS)
+WRITE_BATCH = Histogram("celar_db_write_batch_size", "Write jobs committed in one transaction", buckets=BATCH_BUCKETS)
+
+HASH_TIME = Histogram("celar_password_hash_duration_seconds", "bcrypt time including the wait for a free worker",
+                      ["operation"], buckets=LATENCY_BUCKETS)
+HASH_REJECTED = Counter("celar_password_hash_rejected_total", "bcrypt calls rejected because the queue was full")
+
+LIKE_EVENTS = Counter("celar_like_events_total", "Like, unlike and toggle events", ["action"])
+LIKE_BATCH = Histogram("celar_like_batch_size", "Like events applied in one write job", buckets=BATCH_BUCKETS)
+POSTS_CREATED = Counter("celar_posts_created_total", "Posts created")
+POSTS_DELETED = Counter("celar_posts_deleted_total", "Posts deleted")
+
+def statement_label(sql: str):
+    # "select users" for SELECT ... FROM users, used for statements without a label of their own
+    match = re.search(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", sql, re.IGNORECASE)
+    verb = sql.split(None, 1)[0].lower() if sql.strip() else "empty"
+    return f"{verb} {match.group(1).lower()}" if match else verb
+
+def job_label(func):
+    # "save_post.insert" for a function defined inside save_post
+    return func.__qualname__.replace("<locals>.", "")
+
+def collect():
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+def _alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_dead_processes():
+    # files are named like counter_<pid>.db, the ones of processes that are gone are left over from
+    # earlier runs or crashed workers. signal 0 would kill the process on Windows, so it keeps them
+    if os.name == "nt":
+        return
+    for name in os.listdir(METRICS_DIR):
+        pid = name.rsplit("_", 1)[-1].removesuffix(".db")
+        if pid.isdigit() and not _alive(int(pid)):
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except FileNotFoundError:
+                pass
+
+def process_exiting():
+    # drops this process from the live gauges
+    multiprocess.mark_process_dead(os.getpid())
+
+class MetricsMiddleware:
+    # plain ASGI instead of BaseHTTPMiddleware, so streamed responses are timed until their last chunk
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+        length = 0
+        sent = 0
+
+        async def measured_send(message):
+            nonlocal status, length, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # servers that support it send file responses by path, without body messages
+                if scope["method"] != "HEAD":
+                    length = int(dict(message.get("headers", [])).get(b"content-length", 0))
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, measured_send)
+        finally:
+            IN_PROGRESS.dec()
+            # the router stores the matched route in the scope, its template keeps the label count small
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            REQUESTS.labels(method, route, str(status)).inc()
+            REQUEST_TIME.labels(method, route).observe(time.perf_counter() - start)
+            RESPONSE_SIZE.labels(method, route).observe(sent or length)
@@ -0,0 +1,355 @@
+from ranking import rerank
+import queries
+import sqlite3
+
+# schema changes, applied in order; PRAGMA user_version holds the number of the last one applied.
+# never edit a migration that has shipped, add a new one instead
+
+def base_schema(c: sqlite3.Cursor):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            software TEXT,
+            coins INTEGER NOT NULL DEFAULT 0
+       )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            author TEXT NOT NULL,
+            content BLOB NOT NULL,
+            created_at TEXT NOT NULL,
+            like_count INTEGER NOT NULL DEFAULT 0,
+            content_hash TEXT,
+            content_type TEXT,
+            FOREIGN KEY(author) REFERENCES users(username)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS post_likes (
+            post_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (post_id, username),
+            FOREIGN KEY (post_id) REFERENCES posts(id),
+            FOREIGN KEY (username) REFERENCES users(username)
+        )
+    """)
+    # databases created before the counters existed
+    added_counters = False
+    c.execute("PRAGMA table_info(users)")
+    if "coins" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE users ADD COLUMN coins INTEGER NOT NULL DEFAULT 0")
+        added_counters = True
+    c.execute("PRAGMA table_info(posts)")
+    if "like_count" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0")
+        added_counters = True
+    c.execute("PRAGMA table_info(posts)")
+    if "content_hash" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE posts ADD COLUMN content_hash TEXT")
+    c.execute("PRAGMA table_info(posts)")
+    if "content_type" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE posts ADD COLUMN content_type TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS posts_content_hash ON posts(content_hash)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS revocations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token_hash TEXT,
+            username TEXT NOT NULL,
+            issued_before REAL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS renditions (
+            content_hash TEXT NOT NULL,
+            name TEXT NOT NULL,
+            rendition_hash TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            PRIMARY KEY (content_hash, name)
+        )
+    """)
+    # keep posts.like_count and users.coins in sync with post_likes
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS post_likes_insert AFTER INSERT ON post_likes
+        BEGIN
+            UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+            UPDATE users SET coins = coins + 1
+            WHERE username = (SELECT author FROM posts WHERE id = NEW.post_id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS post_likes_delete AFTER DELETE ON post_likes
+        BEGIN
+            UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+            UPDATE users SET coins = coins - 1
+            WHERE username = (SELECT author FROM posts WHERE id = OLD.post_id);
+        END
+    """)
+    if added_counters:
+        recount_counters(c)
+
+def add_indexes(c: sqlite3.Cursor):
+    # a user's posts (coin recounts, deleting accounts), newest first through the implicit rowid
+    c.execute("CREATE INDEX IF NOT EXISTS posts_author ON posts(author)")
+    # feed ordering by time
+    c.execute("CREATE INDEX IF NOT EXISTS posts_created_at ON posts(created_at)")
+    # a user's likes
+    c.execute("CREATE INDEX IF NOT EXISTS post_likes_username ON post_likes(username)")
+    # checking whether a rendition blob is still used before deleting it
+    c.execute("CREATE INDEX IF NOT EXISTS renditions_rendition_hash ON renditions(rendition_hash)")
+    # pruning expired revocations
+    c.execute("CREATE INDEX IF NOT EXISTS revocations_expires_at ON revocations(expires_at)")
+
+def add_events(c: sqlite3.Cursor):
+    # changes pushed to clients through /events, every worker polls it for rows newer than its last one
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            post_id INTEGER,
+            username TEXT,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    # pruning old events
+    c.execute("CREATE INDEX IF NOT EXISTS events_created_at ON events(created_at)")
+
+# users.software as JSON, or an empty list if it isn't valid JSON
+SOFTWARE_JSON = "CASE WHEN json_valid({0}) THEN {0} ELSE '[]' END"
+
+def add_user_software(c: sqlite3.Cursor):
+    # users.software as rows, so users can be filtered by it. users.software stays the copy that
+    # is returned, with the user's own order and spelling
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS user_software (
+            username TEXT NOT NULL,
+            software TEXT NOT NULL COLLATE NOCASE,
+            PRIMARY KEY (username, software),
+            FOREIGN KEY (username) REFERENCES users(username)
+        ) WITHOUT ROWID
+    """)
+    # users with a software in search order, the index also holds the primary key (the exact username)
+    c.execute("CREATE INDEX IF NOT EXISTS user_software_software ON user_software(software, username COLLATE NOCASE)")
+    # username prefix search and search order
+    c.execute("CREATE INDEX IF NOT EXISTS users_username_nocase ON users(username COLLATE NOCASE, username)")
+    # keep user_software in sync with users.software
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_software_insert AFTER INSERT ON users
+        BEGIN
+            INSERT OR IGNORE INTO user_software (username, software)
+            SELECT NEW.username, value FROM json_each({SOFTWARE_JSON.format("NEW.software")}) WHERE type = 'text';
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_software_update AFTER UPDATE OF software ON users
+        BEGIN
+            DELETE FROM user_software WHERE username = OLD.username;
+            INSERT OR IGNORE INTO user_software (username, software)
+            SELECT NEW.username, value FROM json_each({SOFTWARE_JSON.format("NEW.software")}) WHERE type = 'text';
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_software_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM user_software WHERE username = OLD.username;
+        END
+    """)
+    c.execute(f"""
+        INSERT OR IGNORE INTO user_software (username, software)
+        SELECT users.username, software.value
+        FROM users, json_each({SOFTWARE_JSON.format("users.software")}) AS software
+        WHERE software.type = 'text'
+    """)
+
+def add_post_scores(c: sqlite3.Cursor):
+    # when a coin was given, coins given before count as given with the post
+    c.execute("PRAGMA table_info(post_likes)")
+    if "liked_at" not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE post_likes ADD COLUMN liked_at REAL")
+    # ranked feed order, see ranking.Ranking
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS post_scores (
+            post_id INTEGER PRIMARY KEY,
+            score REAL NOT NULL,
+            FOREIGN KEY (post_id) REFERENCES posts(id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS post_scores_score ON post_scores(score, post_id)")
+    rerank(c)
+
+def add_follows(c: sqlite3.Cursor):
+    c.execute("PRAGMA table_info(users)")
+    columns = [row[1] for row in c.fetchall()]
+    for column in ("follower_count", "following_count", "fanout_pull"):
+        if column not in columns:
+            c.execute(f"ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    # pull is 1 for follows of users with too many followers to push their posts to, copied from
+    # users.fanout_pull of the followee
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS follows (
+            follower TEXT NOT NULL,
+            followee TEXT NOT NULL,
+            pull INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (follower, followee),
+            FOREIGN KEY (follower) REFERENCES users(username),
+            FOREIGN KEY (followee) REFERENCES users(username)
+        ) WITHOUT ROWID
+    """)
+    # a user's followers, for fanning out their posts
+    c.execute("CREATE INDEX IF NOT EXISTS follows_followee ON follows(followee)")
+    # the users whose posts are merged into a home timeline when it is read
+    c.execute("CREATE INDEX IF NOT EXISTS follows_pulled ON follows(follower) WHERE pull = 1")
+    # home timelines, newest first through the post id
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS timelines (
+            username TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (username, post_id),
+            FOREIGN KEY (username) REFERENCES users(username),
+            FOREIGN KEY (post_id) REFERENCES posts(id)
+        ) WITHOUT ROWID
+    """)
+    # removing deleted posts from every timeline
+    c.execute("CREATE INDEX IF NOT EXISTS timelines_post_id ON timelines(post_id)")
+    # posts not fanned out yet, written together with the post
+    c.execute("CREATE TABLE IF NOT EXISTS fanout_queue (post_id INTEGER PRIMARY KEY)")
+    # keep the follow counters in sync with follows
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS follows_insert AFTER INSERT ON follows
+        BEGIN
+            UPDATE users SET follower_count = follower_count + 1 WHERE username = NEW.followee;
+            UPDATE users SET following_count = following_count + 1 WHERE username = NEW.follower;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS follows_delete AFTER DELETE ON follows
+        BEGIN
+            UPDATE users SET follower_count = follower_count - 1 WHERE username = OLD.followee;
+            UPDATE users SET following_count = following_count - 1 WHERE username = OLD.follower;
+        END
+    """)
+    # everyone's timeline starts with their own posts
+    c.execute("INSERT OR IGNORE INTO timelines (username, post_id) SELECT author, id FROM posts")
+
+MIGRATIONS = [
+    base_schema,
+    add_indexes,
+    add_events,
+    add_user_software,
+    add_post_scores,
+    add_follows,
+]
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection):
+    # every worker process runs this at startup, the write lock makes sure only one applies each migration
+    applied = []
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        if schema_version(conn) >= version:
+            conn.rollback()
+            continue
+        try:
+            migration(c)
+            c.execute(f"PRAGMA user_version={version}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied.append(version)
+    return applied
+
+def recount_counters(c: sqlite3.Cursor):
+    c.execute("""
+        SELECT posts.id, posts.like_count, COUNT(post_likes.username)
+        FROM posts
+        LEFT JOIN post_likes ON post_likes.post_id = posts.id
+        GROUP BY posts.id
+        HAVING posts.like_count != COUNT(post_likes.username)
+    """)
+    bad_posts = c.fetchall()
+    c.execute("""
+        SELECT users.username, users.coins, (
+            SELECT COUNT(*)
+            FROM post_likes
+            JOIN posts ON post_likes.post_id = posts.id
+            WHERE posts.author = users.username
+        ) AS actual
+        FROM users
+        WHERE users.coins != actual
+    """)
+    bad_users = c.fetchall()
+    c.execute("""
+        UPDATE posts SET like_count = (
+            SELECT COUNT(*) FROM post_likes WHERE post_likes.post_id = posts.id
+        )
+    """)
+    c.execute("""
+        UPDATE users SET coins = (
+            SELECT COUNT(*)
+            FROM post_likes
+            JOIN posts ON post_likes.post_id = posts.id
+            WHERE posts.author = users.username
+        )
+    """)
+    return bad_posts, bad_users
+
+# the statements from queries.py with sample parameters; `python main.py check-plans` fails if any
+# of them needs a full scan or a temporary b-tree
+HOT_QUERIES = {
+    "login": (queries.PASSWORD_HASH, ("a",)),
+    "profile": (queries.PROFILE, ("a",)),
+    "feed page": (queries.FEED_PAGE, (1, 20)),
+    "feed newer": (queries.FEED_NEWER, (1, 20)),
+    "feed ranked": (queries.FEED_RANKED, (1.0, 1, 20)),
+    "like states": (queries.like_states(2), ("a", 1, 2)),
+    "like state": (queries.LIKE_STATE, (1, "a")),
+    "like batch posts": (queries.batch_posts(2), (1, 2)),
+    "like batch": (queries.batch_likes(2), (1, "a", 2, "b")),
+    "post scores": (queries.post_scores(2), (1, 2)),
+    "liked posts' authors": (queries.liked_posts_authors(2), (1, 2)),
+    # what the post_likes triggers run, they are part of a migration
+    "like trigger": ("UPDATE users SET coins = coins + 1 WHERE username = (SELECT author FROM posts WHERE id = ?)", (1,)),
+    "post content": (queries.POST_CONTENT, (1,)),
+    "rendition": (queries.RENDITION, ("a", "display")),
+    "blob in use": (queries.BLOB_IN_USE, ("a",)),
+    "rendition in use": (queries.RENDITION_IN_USE, ("a",)),
+    "revocations": (queries.REVOCATIONS, (0,)),
+    "prune revocations": (queries.PRUNE_REVOCATIONS, (0,)),
+    "events": (queries.EVENTS, (0,)),
+    "events backlog": (queries.EVENTS_BACKLOG, (0, 1)),
+    "prune events": (queries.PRUNE_EVENTS, (0,)),
+    "software size": (queries.SOFTWARE_SIZE, ("a", 10000)),
+    "user search": queries.user_search("a", [], True, "a", 50),
+    "user search by software": queries.user_search("a", ["a", "b"], True, "a", 50),
+    "home timeline": (queries.HOME_TIMELINE, ("a", 1, 20)),
+    "pulled follows": (queries.PULLED_FOLLOWS, ("a",)),
+    "pulled author's posts": (queries.PULLED_AUTHOR_POSTS, ("a", 1, 20)),
+    "fan out": (queries.FAN_OUT, (1, "a")),
+    "fanout queue": (queries.FANOUT_QUEUE, ()),
+    "unfollow timeline": (queries.UNFOLLOW_TIMELINE, ("a", "b")),
+    "deleted post timelines": (queries.DELETED_POST_TIMELINES, (1,)),
+}
+
+def check_query_plans(conn: sqlite3.Connection):
+    # returns {name: [plan lines]} and the names of the queries with a bad plan,
+    # scanning a table (or all of one of its indexes) counts as bad, scanning the query's own VALUES doesn't
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    plans, bad = {}, []
+    for name, (sql, params) in HOT_QUERIES.items():
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        plans[name] = [row[3] for row in rows]
+        for detail in plans[name]:
+            words = detail.split()
+            full_scan = words[0] == "SCAN" and words[1] in tables
+            if full_scan or detail.startswith("USE TEMP B-TREE"):
+                bad.append(name)
+                break
+    return plans, bad
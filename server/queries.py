@@ -0,0 +1,161 @@
+from typing import List, Optional
+
+# the statements that run on every request or on every write. The modules that run them and
+# HOT_QUERIES in migrations.py (`python main.py check-plans`) both use these, so the plan check
+# always covers the SQL that actually runs
+
+def placeholders(count: int) -> str:
+    return ",".join("?" * count)
+
+PASSWORD_HASH = "SELECT password FROM users WHERE username=?"
+PROFILE = "SELECT username, software, coins, follower_count, following_count FROM users WHERE username=?"
+
+# the first page is a search below the largest possible rowid, so it uses the same plan
+FEED_PAGE = "SELECT id, author, created_at FROM posts WHERE id < ? ORDER BY id DESC LIMIT ?"
+FEED_NEWER = "SELECT id, author, created_at FROM posts WHERE id > ? ORDER BY id ASC LIMIT ?"
+FEED_RANKED = """
+    SELECT posts.id, posts.author, posts.created_at, post_scores.score
+    FROM post_scores
+    JOIN posts ON posts.id = post_scores.post_id
+    WHERE (post_scores.score, post_scores.post_id) < (?, ?)
+    ORDER BY post_scores.score DESC, post_scores.post_id DESC
+    LIMIT ?
+"""
+
+def like_states(count: int) -> str:
+    return f"""
+        SELECT id, like_count, EXISTS(
+            SELECT 1 FROM post_likes WHERE post_id = posts.id AND username = ?
+        )
+        FROM posts
+        WHERE id IN ({placeholders(count)})
+    """
+
+LIKE_STATE = "SELECT 1 FROM post_likes WHERE post_id=? AND username=?"
+
+def batch_posts(count: int) -> str:
+    return f"SELECT id, like_count, created_at FROM posts WHERE id IN ({placeholders(count)})"
+
+def batch_likes(count: int) -> str:
+    # the likes of (post_id, username) pairs
+    return f"""
+        SELECT post_likes.post_id, post_likes.username, post_likes.liked_at
+        FROM (VALUES {','.join(['(?, ?)'] * count)}) AS batch
+        JOIN post_likes ON post_likes.post_id = batch.column1 AND post_likes.username = batch.column2
+    """
+
+def post_scores(count: int) -> str:
+    return f"SELECT post_id, score FROM post_scores WHERE post_id IN ({placeholders(count)})"
+
+def liked_posts_authors(count: int) -> str:
+    return f"""
+        SELECT users.username, users.coins
+        FROM posts
+        JOIN users ON users.username = posts.author
+        WHERE posts.id IN ({placeholders(count)})
+    """
+
+POST_CONTENT = "SELECT content_hash, content_type FROM posts WHERE id=?"
+RENDITION = "SELECT rendition_hash, content_type FROM renditions WHERE content_hash=? AND name=?"
+BLOB_IN_USE = "SELECT 1 FROM posts WHERE content_hash=? LIMIT 1"
+RENDITION_IN_USE = "SELECT 1 FROM renditions WHERE rendition_hash=? LIMIT 1"
+
+REVOCATIONS = "SELECT id, token_hash, username, issued_before, expires_at FROM revocations WHERE id > ? ORDER BY id"
+PRUNE_REVOCATIONS = "DELETE FROM revocations WHERE expires_at <= ?"
+
+EVENTS = "SELECT id, kind, post_id, username, data FROM events WHERE id > ? ORDER BY id LIMIT 1000"
+EVENTS_BACKLOG = "SELECT id, kind, post_id, username, data FROM events WHERE id > ? AND id <= ? ORDER BY id"
+PRUNE_EVENTS = "DELETE FROM events WHERE created_at < ?"
+
+# how many users of a software, counted up to a cap
+SOFTWARE_SIZE = "SELECT COUNT(*) FROM (SELECT 1 FROM user_software WHERE software = ? LIMIT ?)"
+
+def username_range(column: str, prefix: Optional[str], after: Optional[str]):
+    # conditions on a username column the (username COLLATE NOCASE, username) indexes can search by
+    conditions, params = [], []
+    if prefix:
+        # U+10FFFF sorts after every other character
+        conditions += [f"{column} COLLATE NOCASE >= ?", f"{column} COLLATE NOCASE < ?"]
+        params += [prefix, prefix + "\U0010ffff"]
+    if after is not None:
+        # the first condition lets the index skip ahead, the row value orders names that only differ in case
+        conditions += [f"{column} COLLATE NOCASE >= ?", f"({column} COLLATE NOCASE, {column}) > (?, ?)"]
+        params += [after, after, after]
+    return conditions, params
+
+def user_search(prefix: Optional[str], software: List[str], match_all: bool, after: Optional[str], limit: int):
+    # returns (sql, params), with match_all the software is expected rarest first
+    if not software:
+        conditions, params = username_range("username", prefix, after)
+        sql = f"""
+            SELECT username, software
+            FROM users
+            WHERE {" AND ".join(conditions) or "1"}
+            ORDER BY username COLLATE NOCASE, username
+            LIMIT ?
+        """
+    elif match_all or len(software) == 1:
+        # walk the users of the first software and check the others for each of them
+        first, *others = software
+        conditions, params = username_range("user_software.username", prefix, after)
+        conditions = ["user_software.software = ?", *conditions]
+        params = [first, *params]
+        for name in others:
+            conditions.append(
+                "EXISTS (SELECT 1 FROM user_software AS other WHERE other.username = user_software.username AND other.software = ?)"
+            )
+            params.append(name)
+        sql = f"""
+            SELECT users.username, users.software
+            FROM user_software
+            JOIN users ON users.username = user_software.username
+            WHERE {" AND ".join(conditions)}
+            ORDER BY user_software.username COLLATE NOCASE, user_software.username
+            LIMIT ?
+        """
+    else:
+        # the first page of every software merged, each one is a search on the index
+        branches, params = [], []
+        for name in software:
+            conditions, branch_params = username_range("username", prefix, after)
+            branches.append(f"""
+                SELECT username FROM (
+                    SELECT username FROM user_software
+                    WHERE {" AND ".join(["software = ?", *conditions])}
+                    ORDER BY username COLLATE NOCASE, username
+                    LIMIT ?
+                )
+            """)
+            params += [name, *branch_params, limit]
+        sql = f"""
+            SELECT users.username, users.software
+            FROM ({" UNION ".join(branches)}) AS matches
+            JOIN users ON users.username = matches.username
+            ORDER BY matches.username COLLATE NOCASE, matches.username
+            LIMIT ?
+        """
+    return sql, (*params, limit)
+
+HOME_TIMELINE = """
+    SELECT posts.id, posts.author, posts.created_at
+    FROM timelines
+    JOIN posts ON posts.id = timelines.post_id
+    WHERE timelines.username = ? AND timelines.post_id < ?
+    ORDER BY timelines.post_id DESC
+    LIMIT ?
+"""
+PULLED_FOLLOWS = "SELECT followee FROM follows INDEXED BY follows_pulled WHERE follower = ? AND pull = 1"
+PULLED_AUTHOR_POSTS = "SELECT id, author, created_at FROM posts WHERE author = ? AND id < ? ORDER BY id DESC LIMIT ?"
+
+def pulled_authors_posts(count: int) -> str:
+    return f"""
+        SELECT id, author, created_at FROM posts
+        WHERE author IN ({placeholders(count)}) AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+    """
+
+FAN_OUT = "INSERT OR IGNORE INTO timelines (username, post_id) SELECT follower, ? FROM follows WHERE followee = ?"
+FANOUT_QUEUE = "SELECT MIN(post_id) FROM fanout_queue"
+UNFOLLOW_TIMELINE = "DELETE FROM timelines WHERE username = ? AND post_id IN (SELECT id FROM posts WHERE author = ?)"
+DELETED_POST_TIMELINES = "DELETE FROM timelines WHERE post_id=?"
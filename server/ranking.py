@@ -0,0 +1,54 @@
+from datetime import datetime
+import sqlite3
+import math
+import os
+
+# read here instead of in main.py, the migration that fills post_scores needs them as well.
+# run `python main.py rerank` after changing them
+HALF_LIFE = float(os.environ.get("CELAR_RANK_HALF_LIFE", "12")) * 3600
+POST_WEIGHT = float(os.environ.get("CELAR_RANK_POST_WEIGHT", "3"))
+
+def timestamp(created_at: str) -> float:
+    return datetime.fromisoformat(created_at).timestamp()
+
+def logaddexp(a: float, b: float) -> float:
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+class Ranking:
+    # a post's score is the log of its coins plus `post_weight` for the post itself, each one
+    # halved every `half_life` seconds since it was given, so new posts and posts that get coins
+    # quickly come first. Every score loses the same now / tau over time, so post_scores stores
+    # the scores without it: their order never changes by itself and a score only changes when
+    # the post gets or loses a coin
+    def __init__(self, half_life: float = HALF_LIFE, post_weight: float = POST_WEIGHT):
+        self.tau = half_life / math.log(2)
+        self.post_weight = post_weight
+
+    def base(self, created: float) -> float:
+        # the score of a post without coins
+        return math.log(self.post_weight) + created / self.tau
+
+    def add(self, score: float, given_at: float) -> float:
+        return logaddexp(score, given_at / self.tau)
+
+    def remove(self, score: float, given_at: float, created: float) -> float:
+        term = given_at / self.tau
+        base = self.base(created)
+        if term >= score:
+            return base
+        # rounding may leave a little less than the post itself is worth
+        return max(score + math.log1p(-math.exp(term - score)), base)
+
+def rerank(c: sqlite3.Cursor, ranking: Ranking = None):
+    # recomputes every score from post_likes, coins given before liked_at existed count as given with the post
+    ranking = ranking or Ranking()
+    c.execute("SELECT id, created_at FROM posts")
+    created = {post_id: timestamp(created_at) for post_id, created_at in c.fetchall()}
+    scores = {post_id: ranking.base(post_created) for post_id, post_created in created.items()}
+    for post_id, liked_at in c.execute("SELECT post_id, liked_at FROM post_likes"):
+        if post_id in scores:
+            scores[post_id] = ranking.add(scores[post_id], liked_at if liked_at is not None else created[post_id])
+    c.execute("DELETE FROM post_scores")
+    c.executemany("INSERT INTO post_scores (post_id, score) VALUES (?, ?)", scores.items())
+    return len(scores)
@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from starlette.datastructures import MutableHeaders
+import threading
+import gzip
+import orjson
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+def accepted_encoding(accept_encoding: str, zstd: bool = True):
+    # the best encoding both sides support, zstd compresses faster than gzip at a similar ratio
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip()] = quality
+    wildcard = accepted.get("*", 0.0)
+    for encoding in (("zstd", "gzip") if zstd else ("gzip",)):
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+class CompressionMiddleware:
+    # compresses JSON and text responses of at least `minimum_size` bytes with zstd (if the zstandard
+    # package is installed) or gzip. Only responses sent in one piece are compressed, which covers
+    # every JSON response, images are streamed and already compressed
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, zstd_level: int = 3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.zstd = zstandard.ZstdCompressor(level=zstd_level) if zstandard is not None else None
+
+    def compress(self, encoding: str, body: bytes) -> bytes:
+        if encoding == "zstd":
+            return self.zstd.compress(body)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = next((value for key, value in scope["headers"] if key == b"accept-encoding"), b"")
+        encoding = accepted_encoding(accept_encoding.decode("latin-1"), self.zstd is not None)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start = None
+
+        async def compressing_send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # held back until the body shows whether it is worth compressing
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+            response_start, start = start, None
+            headers = MutableHeaders(raw=response_start["headers"])
+            body = message.get("body", b"")
+            if (
+                message["type"] == "http.response.body"
+                and not message.get("more_body", False)
+                and len(body) >= self.minimum_size
+                and "content-encoding" not in headers
+                and headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+            ):
+                body = self.compress(encoding, body)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+                message = {**message, "body": body}
+            await send(response_start)
+            await send(message)
+
+        await self.app(scope, receive, compressing_send)
+
+class PostJSONCache:
+    # LRU of the serialized fields of a post that never change after it was created, feed pages
+    # only add the like fields to them instead of serializing every post again
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _head(self, post_id: int, author: str, created_at: str) -> bytes:
+        with self._lock:
+            head = self._entries.get(post_id)
+            if head is not None:
+                self._entries.move_to_end(post_id)
+                self._hits += 1
+                return head
+            self._misses += 1
+        # without the closing brace, the like fields follow
+        head = orjson.dumps({
+            "id": post_id,
+            "author": author,
+            "content_url": f"/posts/{post_id}/content",
+            "created_at": created_at,
+        })[:-1]
+        with self._lock:
+            self._entries[post_id] = head
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return head
+
+    def render(self, rows, likes) -> bytes:
+        # rows are (id, author, created_at), likes maps the ids to their like state
+        posts = []
+        for post_id, author, created_at in rows:
+            like = likes[post_id]
+            posts.append(b'%s,"like_count":%d,"user_liked":%s}' % (
+                self._head(post_id, author, created_at),
+                like["like_count"],
+                b"true" if like["user_liked"] else b"false",
+            ))
+        return b"[" + b",".join(posts) + b"]"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
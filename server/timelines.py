@@ -0,0 +1,114 @@
+from db import AsyncDatabase, PoolTimeout
+import queries
+import asyncio
+import time
+
+class FanoutWorker:
+    # copies new posts into the home timelines of their author's followers in the background, so
+    # creating a post doesn't wait for it. Posts are queued in fanout_queue together with the post,
+    # so the ones a stopped worker didn't get to are fanned out by the others. Authors with at
+    # least `cutoff` followers aren't fanned out, their posts are merged in when a timeline is read
+    def __init__(self, database: AsyncDatabase, cutoff: int = 5000, backfill: int = 50, interval: float = 5.0):
+        self.database = database
+        self.cutoff = cutoff
+        self.backfill = backfill
+        self.interval = interval
+        self._wakeup = None
+        self._task = None
+        self._posts = 0
+        self._pushed = 0
+        self._pulled = 0
+        self._rows = 0
+        self._time_total = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def notify(self):
+        # a post was queued by this process
+        self.start()
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while await self.database.write(self._fan_out_next):
+                    pass
+            except PoolTimeout:
+                continue
+            except Exception as e:
+                print(f"Could not fan out posts: {e!r}")
+
+    async def _fan_out_next(self, db):
+        # runs on the database writer, returns False once the queue is empty
+        async with db.execute(queries.FANOUT_QUEUE) as c:
+            post_id = (await c.fetchone())[0]
+        if post_id is None:
+            return False
+        start = time.perf_counter()
+        await db.execute("DELETE FROM fanout_queue WHERE post_id = ?", (post_id,))
+        async with db.execute("""
+            SELECT posts.author, users.follower_count, users.fanout_pull
+            FROM posts
+            JOIN users ON users.username = posts.author
+            WHERE posts.id = ?
+        """, (post_id,)) as c:
+            row = await c.fetchone()
+        if row is None:
+            # deleted before it was fanned out
+            return True
+        author, follower_count, was_pull = row
+        pull = follower_count >= self.cutoff
+        if pull != bool(was_pull):
+            await self._switch(db, author, pull)
+        # the author's own timeline always has their posts
+        await db.execute("INSERT OR IGNORE INTO timelines (username, post_id) VALUES (?, ?)", (author, post_id))
+        if pull:
+            self._pulled += 1
+        else:
+            c = await db.execute(queries.FAN_OUT, (post_id, author))
+            self._rows += max(c.rowcount, 0)
+            self._pushed += 1
+        self._posts += 1
+        self._time_total += time.perf_counter() - start
+        return True
+
+    async def _switch(self, db, author: str, pull: bool):
+        # the author crossed the cutoff (or the cutoff changed), the followers' timelines now merge
+        # their posts in when read, or get them pushed again starting with the recent ones
+        await db.execute("UPDATE users SET fanout_pull = ? WHERE username = ?", (int(pull), author))
+        await db.execute("UPDATE follows SET pull = ? WHERE followee = ?", (int(pull), author))
+        if not pull:
+            c = await db.execute("""
+                INSERT OR IGNORE INTO timelines (username, post_id)
+                SELECT follows.follower, recent.id
+                FROM follows, (SELECT id FROM posts WHERE author = ? ORDER BY id DESC LIMIT ?) AS recent
+                WHERE follows.followee = ?
+            """, (author, self.backfill, author))
+            self._rows += max(c.rowcount, 0)
+
+    def stats(self):
+        return {
+            "cutoff": self.cutoff,
+            "posts": self._posts,
+            "pushed": self._pushed,
+            "pulled": self._pulled,
+            "rows": self._rows,
+            "time_total": round(self._time_total, 6),
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
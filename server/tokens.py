@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from db import AsyncDatabase
+import threading
+import hashlib
+import queries
+import time
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+class TokenCache:
+    # LRU of tokens whose signature was already verified, entries expire with the token
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: str, username: str, expires_at: float):
+        with self._lock:
+            self._entries[key] = (username, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_user(self, username: str):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] == username]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+class RevocationList:
+    # revocations are stored in the database so every worker process sees them,
+    # each process pulls new ones at most every `interval` seconds
+    def __init__(self, database: AsyncDatabase, cache: TokenCache, interval: float = 1.0):
+        self.database = database
+        self.cache = cache
+        self.interval = interval
+        self._last_id = 0
+        self._last_sync = 0.0
+        self._tokens = {}
+        self._user_cutoffs = {}
+
+    async def sync(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._last_sync < self.interval:
+            return
+        # set before awaiting so concurrent requests don't all query
+        self._last_sync = now
+        rows = await self.database.fetchall(
+            queries.REVOCATIONS,
+            (self._last_id,)
+        )
+        self._tokens = {key: expires_at for key, expires_at in self._tokens.items() if expires_at > now}
+        for row_id, revoked_hash, username, issued_before, expires_at in rows:
+            if row_id <= self._last_id:
+                continue
+            self._last_id = row_id
+            if expires_at <= now:
+                continue
+            if revoked_hash is not None:
+                self._tokens[revoked_hash] = expires_at
+                self.cache.discard(revoked_hash)
+            else:
+                self._user_cutoffs[username] = max(self._user_cutoffs.get(username, 0), issued_before)
+                self.cache.discard_user(username)
+
+    def is_revoked(self, key: str, username: str, issued_at: float) -> bool:
+        if key in self._tokens:
+            return True
+        cutoff = self._user_cutoffs.get(username)
+        return cutoff is not None and issued_at <= cutoff
+
+    async def _insert(self, revoked_hash, username: str, issued_before, expires_at: float):
+        async def insert(db):
+            await db.execute(queries.PRUNE_REVOCATIONS, (time.time(),))
+            await db.execute(
+                "INSERT INTO revocations (token_hash, username, issued_before, expires_at) VALUES (?, ?, ?, ?)",
+                (revoked_hash, username, issued_before, expires_at)
+            )
+        await self.database.write(insert)
+        await self.sync(force=True)
+
+    async def revoke_token(self, key: str, username: str, expires_at: float):
+        await self._insert(key, username, None, expires_at)
+
+    async def revoke_user(self, username: str, token_lifetime: float):
+        # every token of the user issued up to now
+        now = time.time()
+        await self._insert(None, username, now, now + token_lifetime)